@@ -10,6 +10,10 @@ from src import models, database, routes, webhook
 from src.scheduler import start_scheduler, shutdown_scheduler 
 # Import SessionLocal for scheduler startup
 from src.database import SessionLocal 
+# Shared WhatsApp client, closed on shutdown
+from src.whatsapp import whatsapp_client
+# Adds the current request id to every log record
+from src.request_context import RequestIdFilter
 
 # Load environment variables
 load_dotenv()
@@ -21,19 +25,21 @@ os.makedirs('logs', exist_ok=True)
 log_level = 'DEBUG'
 log_file = os.path.join('logs', 'whatsapp_bot.log')
 
+# File handler with rotation (10MB max size, keep 5 backup files)
+file_handler = RotatingFileHandler(
+    log_file,
+    maxBytes=10*1024*1024,  # 10MB
+    backupCount=5,
+    encoding='utf-8'
+)
+# Tag every record with the id of the webhook request it belongs to ("-" outside requests)
+file_handler.addFilter(RequestIdFilter())
+
 # Configure root logger
 logging.basicConfig(
     level=getattr(logging, log_level),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        # File handler with rotation (10MB max size, keep 5 backup files)
-        RotatingFileHandler(
-            log_file,
-            maxBytes=10*1024*1024,  # 10MB
-            backupCount=5,
-            encoding='utf-8'
-        )
-    ]
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+    handlers=[file_handler]
 )
 logger = logging.getLogger(__name__)
 
@@ -49,6 +55,10 @@ async def lifespan(app: FastAPI):
         logger.info("Starting WhatsApp bot application...")
         # Create database tables
         models.Base.metadata.create_all(bind=database.engine)
+        # create_all skips tables that already exist, so add any indexes introduced since
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=database.engine, checkfirst=True)
         logger.info("Database tables created successfully")
         
         # Get a DB session for starting the scheduler
@@ -65,6 +75,9 @@ async def lifespan(app: FastAPI):
         # Shutdown the scheduler
         shutdown_scheduler()
         logger.info("Scheduler shut down")
+        # Close pooled WhatsApp API connections
+        await whatsapp_client.aclose()
+        logger.info("WhatsApp HTTP client closed")
         # Close the DB session if it was opened
         if db:
             db.close()
@@ -94,6 +107,8 @@ def create_app() -> FastAPI:
 server = create_app()
 
 if __name__ == "__main__":
+    # uvicorn picks uvloop and httptools automatically when installed. Keep a single worker:
+    # the scheduler and its caches live in-process, so extra workers would each send the questions
     uvicorn.run(
         "main:server",
         host="0.0.0.0",
@@ -9,7 +9,7 @@ class ActiveUserManager:
     Manages the list of active users fetched from external API.
     """
     def __init__(self):
-        self.active_numbers = set()
+        self.active_numbers = frozenset()
         self._load_active_users()
 
     def _load_active_users(self):
@@ -37,7 +37,8 @@ class ActiveUserManager:
                 # If starts with '51' and has 11 digits, also add stripped version (9 digits)
                 elif num_stripped.startswith('51') and len(num_stripped) == 11:
                     normalized.add(num_stripped[2:])
-            self.active_numbers = normalized
+            # Swap in a frozenset in one assignment so concurrent lookups never see a partial set
+            self.active_numbers = frozenset(normalized)
             logger.info(f"Loaded {len(numbers)} active user numbers. Stored {len(self.active_numbers)} normalized variations.")
             logger.debug(f"Stored normalized active numbers (sample): {list(self.active_numbers)[:20]}") # Log a sample
         except Exception as e:
@@ -59,12 +60,17 @@ class ActiveUserManager:
         except Exception as err:
             logger.error(f"Error cleaning up scheduled jobs: {err}")
 
+    def active_phone_numbers(self) -> frozenset:
+        """Return the current set of active phone numbers (all normalized variations)"""
+        return self.active_numbers
+
     def is_active(self, phone_number: str) -> bool:
         """Check if a given phone number is in the active set"""
-        logger.debug(f"Checking if number '{phone_number}' is active...")
-        # Normalize format if needed (API returns numbers without '+' and with country code)
+        # Plain O(1) set membership; API numbers are stored without '+' and in both
+        # with/without country code forms. Debug output is formatted lazily so the
+        # hot path never copies the set.
         is_present = phone_number in self.active_numbers
-        logger.debug(f"Result for '{phone_number}': {is_present}. (Set sample: {list(self.active_numbers)[:10]})")
+        logger.debug("Active check for '%s': %s", phone_number, is_present)
         return is_present
 
 # Create singleton instance
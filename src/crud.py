@@ -3,7 +3,8 @@ from . import models, schemas
 from sqlalchemy.exc import IntegrityError
 
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    # Primary-key lookup: served from the session's identity map when already loaded
+    return db.get(models.User, user_id)
 
 def get_user_by_phone(db: Session, phone_number: str):
     return db.query(models.User).filter(models.User.phone_number == phone_number).first()
@@ -11,6 +12,10 @@ def get_user_by_phone(db: Session, phone_number: str):
 def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.User).offset(skip).limit(limit).all()
 
+def iter_users(db: Session, batch_size: int = 500):
+    """Iterate over all users, fetching `batch_size` rows at a time instead of loading them all"""
+    return db.query(models.User).order_by(models.User.id).yield_per(batch_size)
+
 def create_user(db: Session, user: schemas.UserCreate):
     db_user = models.User(**user.model_dump())
     try:
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -8,9 +8,43 @@ load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./banquea_bot.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers proceed during writes; NORMAL sync is durable under WAL with fewer fsyncs"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def create_pooled_engine(url: str, **pool_options):
+    """
+    Create an engine with a connection pool, applying the SQLite-specific
+    connect args and PRAGMAs when `url` points at SQLite.
+    
+    Args:
+        url: Database URL
+        **pool_options: Pool settings passed through to create_engine
+        
+    Returns:
+        SQLAlchemy Engine
+    """
+    is_sqlite = url.startswith("sqlite")
+    # check_same_thread is a SQLite-only driver option
+    connect_args = {"check_same_thread": False} if is_sqlite else {}
+    engine = create_engine(url, connect_args=connect_args, pool_pre_ping=True, **pool_options)
+    if is_sqlite:
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+# Size the pool for the webhook handlers plus the scheduler jobs that open their own sessions
+engine = create_pooled_engine(
+    SQLALCHEMY_DATABASE_URL,
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=3600,
 )
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -1,19 +1,40 @@
+import asyncio
 import logging
-from typing import Dict, Any, Optional
+import re
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy import select, update, bindparam
 from sqlalchemy.orm import Session
 from datetime import datetime
-import pytz
+from zoneinfo import ZoneInfo
 
 from .models import User, UserState, UserQuestion
-from .whatsapp import WhatsAppClient
+from .whatsapp import whatsapp_client
 from . import crud
+# Import the module rather than its names so the scheduler <-> handler import cycle resolves in any order
+from . import scheduler
 from .questions import question_manager
 from .active_users import active_user_manager
 
 logger = logging.getLogger(__name__)
 
-# Create WhatsApp client instance
-whatsapp_client = WhatsAppClient()
+# Handlers end the session's transaction (commit) before every awaited WhatsApp send, so no
+# pooled connection is held for the length of an HTTP call. The commit expires loaded objects,
+# so anything needed after it (phone number, reply text) is read into locals first.
+
+# Lima, Peru timezone for answer timestamps
+LIMA_TZ = ZoneInfo('America/Lima')
+
+# Strong references to fire-and-forget send tasks so they are not garbage collected mid-flight
+_background_tasks = set()
+
+def send_in_background(coro) -> asyncio.Task:
+    """
+    Schedule a non-critical send without waiting for it, so the webhook can return immediately.
+    """
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 def format_ai_commentary(discussion: str = None, justification: str = None, source: str = None) -> str:
     """
@@ -65,6 +86,18 @@ DAY_NAMES = {
     6: "Domingo"
 }
 
+# Most recent unanswered question for a user; built once so SQLAlchemy reuses its compiled form
+PENDING_QUESTION_STMT = (
+    select(UserQuestion)
+    .where(UserQuestion.user_id == bindparam('uid'), UserQuestion.answered_at.is_(None))
+    .order_by(UserQuestion.sent_at.desc())
+    .limit(1)
+)
+
+# Accepted confirmation replies (button payload or typed text), matched case-insensitively
+CONFIRM_YES_RE = re.compile(r'\s*(?:estoy listo (?:para )?reforzar|s[ií]|ok)\s*', re.IGNORECASE)
+CONFIRM_NO_RE = re.compile(r'\s*(?:hoy no quiero repasar|no(?: quiero(?: (?:repasar|reforzar))?)?)\s*', re.IGNORECASE)
+
 async def handle_message(db: Session, message: Dict[str, Any]) -> Dict[str, Any]:
     """
     Main message handler - processes incoming messages based on user state
@@ -76,74 +109,100 @@ async def handle_message(db: Session, message: Dict[str, Any]) -> Dict[str, Any]
     Returns:
         Dict with processing result
     """
-    # Ignore non-message events (like status updates)
+    # Ignore non-message events (like status updates). Cold path: the webhook route
+    # already filters status-only payloads before they get here.
     if message.get("type") != "message":
-        logger.info(f"Ignoring non-message event: {message.get('type')}")
+        logger.info("Ignoring non-message event: %s", message.get("type"))
         return {"status": "ignored", "reason": "not_a_message"}
     
     from_number = message.get("from_number")
+    if not from_number:
+        logger.error("Message missing sender phone number")
+        return {"status": "error", "reason": "missing_phone_number"}
+
     message_type = message.get("message_type")
-    body = message.get("body", "")
+    # Normalize the body once; state handlers read the stripped value back from the message
+    body = (message.get("body") or "").strip()
+    message["body"] = body
     # Get or create user from database
     user = crud.get_user_by_phone(db, from_number)
     if not user:
-        logger.warning(f"Received message from unknown user: {from_number}")
+        logger.warning("Received message from unknown user: %s", from_number)
         return {"status": "error", "reason": "unknown_user"}
     
-    logger.debug(f"User found: ID={user.id}, State={user.state}") # Add user state debug log
+    logger.debug("User found: ID=%s, State=%s", user.id, user.state) # Add user state debug log
 
-    # Check for special command to get a new question
-    if message_type == "text" and body.strip() == "%%get_new_question$$":
+    # Check for special command to get a new question. Handled before the active-number
+    # gate, so it also works for numbers that are not (or no longer) active
+    if message_type == "text" and body == "%%get_new_question$$":
         return await handle_force_new_question(db, user)
     
     # Only process messages from active users
-    logger.debug(f"Checking active status for number: {from_number}") # Log number before check
+    logger.debug("Checking active status for number: %s", from_number) # Log number before check
     if not active_user_manager.is_active(from_number) and from_number != "51973296571": # Allow test number
-        logger.info(f"Ignoring message from inactive number: {from_number}")
+        logger.info("Ignoring message from inactive number: %s", from_number)
         return {"status": "ignored", "reason": "inactive_user"}
-
-    
-    if not from_number:
-        logger.error("Message missing sender phone number")
-        return {"status": "error", "reason": "missing_phone_number"}
     
-    logger.info(f"Processing message from {from_number}: {body[:50]}...")
+    logger.info("Processing message from %s: %.50s...", from_number, body)
     
-    # Update whatsapp_id if not set
-    if not user.whatsapp_id:
+    # Set whatsapp_id if missing. No commit here: the session does not autoflush, so the
+    # change is written in the same UPDATE as the state handler's commit. If nothing commits
+    # (SUBSCRIBED users), the column stays NULL and is retried on the next message.
+    if user.whatsapp_id is None:
         user.whatsapp_id = from_number
-        db.commit()
-        logger.info(f"Updated WhatsApp ID for user {from_number}")
+        logger.info("Setting WhatsApp ID for user %s", from_number)
     
 
     # Process message based on user state
-    if user.state == UserState.UNCONTACTED:
-        return await handle_uncontacted_user(db, user, message)
-    elif user.state == UserState.AWAITING_DAY:
-        return await handle_day_selection(db, user, message)
-    elif user.state == UserState.AWAITING_HOUR:
-        return await handle_hour_selection(db, user, message)
-    elif user.state == UserState.AWAITING_QUESTION_CONFIRMATION:
-        return await handle_question_confirmation(db, user, message)
-    elif user.state == UserState.AWAITING_QUESTION_RESPONSE:
-        return await handle_question_response(db, user, message)
+    handler = STATE_HANDLERS.get(user.state)
+    if handler:
+        return await handler(db, user, message)
     elif user.state == UserState.SUBSCRIBED:
         # Handle subscribed user state
-        logger.info(f"User {user.phone_number} is in SUBSCRIBED state. No specific action required.")
+        logger.info("User %s is in SUBSCRIBED state. No specific action required.", user.phone_number)
         return {"status": "success", "action": "no_action_needed"}
     else:
-        logger.error(f"Unknown user state: {user.state} for user {from_number}")
+        logger.error("Unknown user state: %s for user %s", user.state, from_number)
+        db.commit()
         await whatsapp_client.send_text_message(
             to_number=from_number,
             message_text="Lo siento, ha ocurrido un error. Por favor, intente más tarde."
         )
         return {"status": "error", "reason": "unknown_state"}
 
+async def _send_welcome_template(from_number: str) -> Dict[str, Any]:
+    """Send the first-contact template and return the handler result for it"""
+    success = await whatsapp_client.send_template_message(
+        to_number=from_number,
+        template_name="primer_contacto"
+    )
+    
+    if not success:
+        logger.error("Failed to send welcome template to %s", from_number)
+        return {"status": "error", "reason": "template_send_failed"}
+    
+    logger.info("Sent welcome template to %s, user is now AWAITING_DAY", from_number)
+    return {"status": "success", "action": "sent_welcome_and_day_selection"}
+
+def _release_failed_contacts(db: Session, user_ids: List[int]) -> None:
+    """Put users whose welcome template failed back in UNCONTACTED, unless they moved on meanwhile"""
+    if not user_ids:
+        return
+    db.execute(
+        update(User)
+        .where(User.id.in_(user_ids), User.state == UserState.AWAITING_DAY)
+        .values(state=UserState.UNCONTACTED)
+    )
+    db.commit()
+
 async def handle_uncontacted_user(db: Session, user: User, message: Dict[str, Any]) -> Dict[str, Any]:
     """
     Handle a message from a user in UNCONTACTED state.
     Send the initial welcome messages and update state.
     
+    The state change is committed before the send and released again if the send fails,
+    so the session holds no connection while waiting on WhatsApp.
+    
     Args:
         db: Database session
         user: User model instance
@@ -152,25 +211,87 @@ async def handle_uncontacted_user(db: Session, user: User, message: Dict[str, An
     Returns:
         Dict with processing result
     """
+    user_id = user.id
     from_number = user.phone_number
-    logger.info(f"Handling message from uncontacted user: {from_number}")
+    logger.info("Handling message from uncontacted user: %s", from_number)
+    
+    # Claim the user with a conditional UPDATE, like contact_uncontacted_users, so a
+    # concurrent batch never sends the welcome template to the same user twice
+    claimed = db.execute(
+        update(User)
+        .where(User.id == user_id, User.state == UserState.UNCONTACTED)
+        .values(state=UserState.AWAITING_DAY)
+        .returning(User.id)
+    ).scalar_one_or_none()
+    db.commit()
+    if claimed is None:
+        return {"status": "error", "reason": "already_claimed"}
     
     # Send welcome template message
-    success = await whatsapp_client.send_template_message(
-        to_number=from_number,
-        template_name="primer_contacto"
-    )
+    result = await _send_welcome_template(from_number)
+    if result["status"] != "success":
+        _release_failed_contacts(db, [user_id])
+    return result
+
+# Bounded fan-out for bulk welcome messages: at most CONTACT_CONCURRENCY sends in flight,
+# each slot held a little longer so bursts stay under WhatsApp's rate limits
+CONTACT_CONCURRENCY = 5
+CONTACT_SPACING_SECONDS = 0.2
+
+async def contact_uncontacted_users(db: Session, users: List[User]) -> List[Any]:
+    """
+    Send the welcome template to several users concurrently, with the same result
+    per user as handle_uncontacted_user.
     
-    if not success:
-        logger.error(f"Failed to send welcome template to {from_number}")
-        return {"status": "error", "reason": "template_send_failed"}
+    Users are claimed first with one conditional UPDATE (UNCONTACTED -> AWAITING_DAY),
+    so concurrent batches (the /users/contact route and the daily job) never send the
+    welcome template to the same user twice. The claim is committed before any send, so
+    the session holds no connection during the fan-out. Failed contacts are released back
+    to UNCONTACTED in a single UPDATE afterwards.
     
-    # Update user state
-    user.state = UserState.AWAITING_DAY
+    Args:
+        db: Database session shared by all contacts
+        users: Users in UNCONTACTED state to welcome
+        
+    Returns:
+        One entry per user, in order: the result dict, or the exception the send raised
+    """
+    if not users:
+        return []
+    
+    user_ids = [user.id for user in users]
+    # Claim the batch; only rows still UNCONTACTED are returned, whoever got there first wins
+    claimed = dict(db.execute(
+        update(User)
+        .where(User.id.in_(user_ids), User.state == UserState.UNCONTACTED)
+        .values(state=UserState.AWAITING_DAY)
+        .returning(User.id, User.phone_number)
+    ).all())
     db.commit()
     
-    logger.info(f"Updated user {from_number} state to AWAITING_DAY")
-    return {"status": "success", "action": "sent_welcome_and_day_selection"}
+    semaphore = asyncio.Semaphore(CONTACT_CONCURRENCY)
+    failed_ids = []
+
+    async def contact_one(user_id: int) -> Dict[str, Any]:
+        if user_id not in claimed:
+            return {"status": "error", "reason": "already_claimed"}
+        async with semaphore:
+            try:
+                result = await _send_welcome_template(claimed[user_id])
+            except Exception:
+                failed_ids.append(user_id)
+                raise
+            if result["status"] != "success":
+                failed_ids.append(user_id)
+            await asyncio.sleep(CONTACT_SPACING_SECONDS)
+            return result
+
+    results = await asyncio.gather(*(contact_one(user_id) for user_id in user_ids), return_exceptions=True)
+    # Persist the releases of failed contacts at once
+    _release_failed_contacts(db, failed_ids)
+    # Reload the batch in one query (the commits expired it) for callers reporting on it
+    db.query(User).filter(User.id.in_(user_ids)).all()
+    return results
 
 async def handle_day_selection(db: Session, user: User, message: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -186,18 +307,19 @@ async def handle_day_selection(db: Session, user: User, message: Dict[str, Any])
         Dict with processing result
     """
     from_number = user.phone_number
-    body = message.get("body", "").strip()
+    body = message.get("body", "")
     
-    logger.info(f"Processing day selection from {from_number}: '{body}'")
+    logger.info("Processing day selection from %s: '%s'", from_number, body)
     
     # Validate day name
     if body not in DAY_MAPPING:
         # Send error message
+        db.commit()
         await whatsapp_client.send_text_message(
             to_number=from_number,
             message_text="El día seleccionado no es válido. Por favor, escribe el nombre del día con la primera letra en mayúscula (por ejemplo: Lunes, Martes, etc.)."
         )
-        logger.warning(f"Invalid day name from {from_number}: '{body}'")
+        logger.warning("Invalid day name from %s: '%s'", from_number, body)
         return {"status": "error", "reason": "invalid_day"}
     
     # Save selected day to database
@@ -206,7 +328,7 @@ async def handle_day_selection(db: Session, user: User, message: Dict[str, Any])
     user.state = UserState.AWAITING_HOUR
     db.commit()
     
-    logger.info(f"User {from_number} selected day: {body} (index: {day_number})")
+    logger.info("User %s selected day: %s (index: %s)", from_number, body, day_number)
     
     # Send hour selection template
     success = await whatsapp_client.send_template_message(
@@ -215,11 +337,31 @@ async def handle_day_selection(db: Session, user: User, message: Dict[str, Any])
     )
     
     if not success:
-        logger.error(f"Failed to send hour selection template to {from_number}")
+        logger.error("Failed to send hour selection template to %s", from_number)
         return {"status": "error", "reason": "template_send_failed"}
     
     return {"status": "success", "action": "processed_day", "selected_day": body}
 
+def _parse_hhmm(text: str) -> Optional[Tuple[int, int]]:
+    """
+    Parse an "H:MM"/"HH:MM" time with plain ASCII digit checks, so malformed input never raises.
+    
+    Returns:
+        (hour, minute) tuple, or None if the text is not a valid time of day
+    """
+    hour_str, separator, minute_str = text.partition(':')
+    if not (
+        separator == ':'
+        and 1 <= len(hour_str) <= 2 and hour_str.isascii() and hour_str.isdigit()
+        and 1 <= len(minute_str) <= 2 and minute_str.isascii() and minute_str.isdigit()
+    ):
+        return None
+    hour = int(hour_str)
+    minute = int(minute_str)
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
 async def handle_hour_selection(db: Session, user: User, message: Dict[str, Any]) -> Dict[str, Any]:
     """
     Handle hour selection from a user in AWAITING_HOUR state.
@@ -234,44 +376,38 @@ async def handle_hour_selection(db: Session, user: User, message: Dict[str, Any]
         Dict with processing result
     """
     from_number = user.phone_number
-    body = message.get("body", "").strip()
+    body = message.get("body", "")
     
-    logger.info(f"Processing hour selection from {from_number}: '{body}'")
+    logger.info("Processing hour selection from %s: '%s'", from_number, body)
     
     # Validate hour format (HH:MM)
-    try:
-        # Attempt to parse HH:MM format
-        time_parts = body.split(':')
-        if len(time_parts) != 2:
-            raise ValueError("Invalid format, expected HH:MM")
-            
-        hour_str, minute_str = time_parts
-        hour = int(hour_str)
-        minute = int(minute_str) # Validate minute part as well
-        
-        if not (0 <= hour <= 23 and 0 <= minute <= 59):
-            raise ValueError("Hour or minute out of range")
-            
-    except ValueError as e:
+    parsed = _parse_hhmm(body)
+    if parsed is None:
         # Send error message
         error_message = "La hora seleccionada no es válida. Por favor, ingresa la hora en formato HH:MM (por ejemplo, 09:30 o 14:00)."
+        db.commit()
         await whatsapp_client.send_text_message(
             to_number=from_number,
             message_text=error_message
         )
-        logger.warning(f"Invalid time format from {from_number}: '{body}'. Error: {e}")
+        logger.warning("Invalid time format from %s: '%s'", from_number, body)
         return {"status": "error", "reason": "invalid_hour_format"}
     
+    hour, minute = parsed
+    
     # Save selected hour and minute to database
     user.scheduled_hour = hour
     user.scheduled_minute = minute # Save the minute
     user.state = UserState.SUBSCRIBED
+    day_of_week = user.scheduled_day_of_week
+    # Schedule the first question confirmation while the user is still loaded, then commit
+    next_time = scheduler.schedule_next_question(user, db)
     db.commit()
     
-    logger.info(f"User {from_number} selected time: {hour:02d}:{minute:02d} (Day: {user.scheduled_day_of_week})")
+    logger.info("User %s selected time: %02d:%02d (Day: %s)", from_number, hour, minute, day_of_week)
     
     # Get day name for confirmation message
-    day_name = DAY_NAMES.get(user.scheduled_day_of_week, "día desconocido")
+    day_name = DAY_NAMES.get(day_of_week, "día desconocido")
     
     # Send confirmation message (using the selected hour and minute)
     confirmation_msg = (
@@ -285,10 +421,6 @@ async def handle_hour_selection(db: Session, user: User, message: Dict[str, Any]
         message_text=confirmation_msg
     )
     
-    # Schedule the first question confirmation
-    from .scheduler import schedule_next_question
-    next_time = schedule_next_question(user, db)
-    
     return {
         "status": "success", 
         "action": "processed_hour", 
@@ -310,50 +442,45 @@ async def handle_question_confirmation(db: Session, user: User, message: Dict[st
         Dict with processing result
     """
     from_number = user.phone_number
-    body = message.get("body", "").strip()
+    body = message.get("body", "")
     message_type = message.get("message_type")
     
-    logger.info(f"Processing question confirmation from {from_number}: '{body}'")
-    
-    # Extract the response - it could be a button or text
-    user_response = body.lower()
+    logger.info("Processing question confirmation from %s: '%s'", from_number, body)
     
-    # Check for button response type
-    if message_type == "button":
-        payload = message.get("interactive_data", {}).get("payload", "")
-        if payload:
-            user_response = payload.lower()
+    # Extract the response - prefer the button payload, fall back to the text body
+    payload = message.get("interactive_data", {}).get("payload", "") if message_type == "button" else ""
+    user_response = payload or body
     
     # Handle the confirmation response
     # Check if the response indicates readiness (accept the specific payload)
-    if user_response in ["estoy listo reforzar", "Estoy listo para reforzar", "estoy listo para reforzar", "si", "sí", "ok"]:
-        logger.info(f"User {from_number} confirmed to receive a question")
-        
-        # Import here to avoid circular import
-        from .scheduler import send_random_question
+    if CONFIRM_YES_RE.fullmatch(user_response):
+        logger.info("User %s confirmed to receive a question", from_number)
+        user_id = user.id
+        db.commit()
         
         # Send a question immediately (no need for db session here, send_random_question creates its own)
-        await send_random_question(user.id)
+        await scheduler.send_random_question(user_id)
         
         return {"status": "success", "action": "sending_question"}
     
     # Handle negative confirmation or unrecognized response
-    elif user_response in ["Hoy no quiero repasar", "hoy no quiero repasar", "no", "no quiero", "no quiero repasar", "no quiero reforzar"]:
-        logger.info(f"User {from_number} declined to receive a question now")
+    elif CONFIRM_NO_RE.fullmatch(user_response):
+        logger.info("User %s declined to receive a question now", from_number)
         # Reschedule for the next planned time
         user.state = UserState.SUBSCRIBED # Put back into subscribed state
+        next_time = scheduler.schedule_next_question(user, db)
         db.commit()
-        from .scheduler import schedule_next_question
-        next_time = schedule_next_question(user, db)
-        await whatsapp_client.send_text_message(
+        # Acknowledgement is not critical, don't hold the webhook response for it
+        send_in_background(whatsapp_client.send_text_message(
             to_number=from_number,
             message_text="Entendido. Te preguntaré de nuevo en tu próximo horario programado."
-        )
+        ))
         return {"status": "success", "action": "confirmation_declined", "next_scheduled": next_time.isoformat() if next_time else None}
         
     else:
         # Unrecognized response
-        logger.warning(f"Unrecognized confirmation response from {from_number}: '{body}' (parsed as '{user_response}')")
+        logger.warning("Unrecognized confirmation response from %s: '%s' (parsed as '%s')", from_number, body, user_response)
+        db.commit()
         await whatsapp_client.send_text_message(
             to_number=from_number,
             message_text="Lo siento, no entendí tu respuesta. Por favor, selecciona una de las opciones."
@@ -377,16 +504,13 @@ async def handle_question_response(db: Session, user: User, message: Dict[str, A
     message_type = message.get("message_type")
     interactive_data = message.get("interactive_data", {})
     
-    logger.info(f"Processing question response from {from_number}")
+    logger.info("Processing question response from %s", from_number)
     
     # Get the most recent unanswered question for this user
-    last_question = db.query(UserQuestion).filter(
-        UserQuestion.user_id == user.id,
-        UserQuestion.answered_at.is_(None)
-    ).order_by(UserQuestion.sent_at.desc()).first()
+    last_question = db.execute(PENDING_QUESTION_STMT, {'uid': user.id}).scalar_one_or_none()
     
     if not last_question:
-        logger.warning(f"No pending question found for user {from_number}")
+        logger.warning("No pending question found for user %s", from_number)
         
         # Update user state
         user.state = UserState.SUBSCRIBED
@@ -408,36 +532,36 @@ async def handle_question_response(db: Session, user: User, message: Dict[str, A
             answer_title = interactive_data.get("title")
             
             if not answer_id or not answer_title:
-                logger.warning(f"Invalid list reply from {from_number}: {interactive_data}")
+                logger.warning("Invalid list reply from %s: %s", from_number, interactive_data)
                 return {"status": "error", "reason": "invalid_list_reply"}
             
             # Record the answer
+            is_correct = (answer_id == last_question.correct_answer_id)
+            correct_answer = last_question.correct_answer
+            question_id = last_question.question_id
             last_question.user_answer = answer_title
-            last_question.answered_at = datetime.now(pytz.timezone('America/Lima'))
-            last_question.is_correct = (answer_id == last_question.correct_answer_id)
+            last_question.answered_at = datetime.now(LIMA_TZ)
+            last_question.is_correct = is_correct
             
-            # Update user state
+            # Update user state and schedule the next question before the commit expires the user
             user.state = UserState.SUBSCRIBED
+            next_time = scheduler.schedule_next_question(user, db)
             db.commit()
             
-            logger.info(f"User {from_number} answered question {last_question.question_id}: " + 
-                       f"'{answer_title}' - Correct: {last_question.is_correct}")
+            logger.info("User %s answered question %s: '%s' - Correct: %s",
+                        from_number, question_id, answer_title, is_correct)
             
-            # Send feedback based on correctness
-            if last_question.is_correct:
-                await whatsapp_client.send_text_message(
-                    to_number=from_number,
-                    message_text="¡Respuesta correcta! 🎉 Muy bien. Recibirás tu próxima pregunta en el horario programado."
-                )
+            # Build feedback based on correctness
+            if is_correct:
+                feedback_msg = "¡Respuesta correcta! 🎉 Muy bien. Recibirás tu próxima pregunta en el horario programado."
             else:
-                await whatsapp_client.send_text_message(
-                    to_number=from_number,
-                    message_text=f"Tu respuesta fue incorrecta. La respuesta correcta es: {last_question.correct_answer}\n\n" +
-                                f"Recibirás tu próxima pregunta en el horario programado."
+                feedback_msg = (
+                    f"Tu respuesta fue incorrecta. La respuesta correcta es: {correct_answer}\n\n"
+                    f"Recibirás tu próxima pregunta en el horario programado."
                 )
             # Incluir comentarios AI (discusión, justificación y fuente)
             # Normalize question_id to int if stored as bytes
-            qid = last_question.question_id
+            qid = question_id
             if isinstance(qid, (bytes, bytearray)):
                 try:
                     qid = int.from_bytes(qid, 'little')
@@ -445,38 +569,34 @@ async def handle_question_response(db: Session, user: User, message: Dict[str, A
                     try:
                         qid = int(qid.decode('utf-8'))
                     except Exception:
-                        logger.error(f"Could not convert question_id {last_question.question_id} to int for AI lookup")
+                        logger.error("Could not convert question_id %s to int for AI lookup", question_id)
                         qid = None
             # Retrieve AI data
-            ai_info = question_manager.ai_data.get(qid, {}) if qid is not None else {}
-            logger.info(f"AI commentary raw data for question {qid}: {ai_info}")
+            ai_info = (question_manager.ai_data.get(qid) if qid is not None else None) or {}
+            logger.info("AI commentary raw data for question %s: %s", qid, ai_info)
             discussion = ai_info.get('discussion_ai')
             justification = ai_info.get('justification_ai')
             source = ai_info.get('source_ai')
-            logger.info(f"Parsed AI commentary: discussion={discussion}, justification={justification}, source={source}")
-            if discussion or justification or source:
-                # Use helper to format AI commentary
-                ai_text = format_ai_commentary(discussion, justification, source)
-                logger.info(f"Sending formatted AI commentary to {from_number}: {ai_text[:200]}")
-                await whatsapp_client.send_text_message(
-                    to_number=from_number,
-                    message_text=ai_text
-                )
+            ai_text = format_ai_commentary(discussion, justification, source) if (discussion or justification or source) else ""
             
-            # Schedule next question
-            from .scheduler import schedule_next_question
-            next_time = schedule_next_question(user, db)
+            # Feedback then AI commentary; send_many keeps the two in order for this recipient
+            replies = [(from_number, feedback_msg)]
+            if ai_text:
+                logger.info("Sending formatted AI commentary to %s: %.200s", from_number, ai_text)
+                replies.append((from_number, ai_text))
+            await whatsapp_client.send_many(replies)
             
             return {
                 "status": "success",
                 "action": "processed_answer",
-                "is_correct": last_question.is_correct,
+                "is_correct": is_correct,
                 "next_scheduled": next_time.isoformat()
             }
     
     # Unrecognized response format
-    logger.warning(f"Unrecognized question response format from {from_number}: {message_type}")
+    logger.warning("Unrecognized question response format from %s: %s", from_number, message_type)
     
+    db.commit()
     await whatsapp_client.send_text_message(
         to_number=from_number,
         message_text="Lo siento, no pude procesar tu respuesta. Por favor, selecciona una opción de la lista proporcionada."
@@ -495,22 +615,32 @@ async def handle_force_new_question(db: Session, user: User) -> Dict[str, Any]:
     Returns:
         Dict with processing result
     """
+    user_id = user.id
     from_number = user.phone_number
-    logger.info(f"Handling force new question command from {from_number}")
+    logger.info("Handling force new question command from %s", from_number)
     
     # Only allow this command for subscribed users
-    if user.state not in [UserState.SUBSCRIBED, UserState.AWAITING_QUESTION_CONFIRMATION]:
+    state = user.state
+    db.commit()
+    if state not in [UserState.SUBSCRIBED, UserState.AWAITING_QUESTION_CONFIRMATION]:
         await whatsapp_client.send_text_message(
             to_number=from_number,
             message_text="Lo siento, este comando solo está disponible después de completar la configuración inicial."
         )
         return {"status": "error", "reason": "invalid_state_for_command"}
     
-    # Import here to avoid circular import
-    from .scheduler import send_random_question
-    
     # Send a question directly without changing the schedule
     # Pass only user.id as send_random_question creates its own DB session
-    await send_random_question(user.id)
+    await scheduler.send_random_question(user_id)
     
     return {"status": "success", "action": "forced_new_question"}
+
+# Handler for each conversational state, dispatched from handle_message.
+# SUBSCRIBED (no action) and unknown states are handled explicitly there.
+STATE_HANDLERS = {
+    UserState.UNCONTACTED: handle_uncontacted_user,
+    UserState.AWAITING_DAY: handle_day_selection,
+    UserState.AWAITING_HOUR: handle_hour_selection,
+    UserState.AWAITING_QUESTION_CONFIRMATION: handle_question_confirmation,
+    UserState.AWAITING_QUESTION_RESPONSE: handle_question_response,
+}
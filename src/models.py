@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Boolean, Text
+from sqlalchemy import Column, Integer, String, Enum, DateTime, ForeignKey, Boolean, Text, Index, text
 from sqlalchemy.orm import relationship
 from .database import Base
 import enum
@@ -22,7 +22,7 @@ class User(Base):
     scheduled_minute = Column(Integer, default=0) # 0-59, Add default
     scheduled_day_of_week = Column(Integer)  # 0-6 (Monday-Sunday)
     whatsapp_id = Column(String, unique=True, nullable=True) # Allow nullable initially
-    state = Column(Integer, default=UserState.UNCONTACTED)
+    state = Column(Integer, default=UserState.UNCONTACTED, index=True)
     last_interaction_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationship to track questions sent to this user
@@ -33,6 +33,16 @@ class UserQuestion(Base):
     Model to track questions sent to users and their responses.
     """
     __tablename__ = "user_questions"
+    __table_args__ = (
+        # Serves the pending-question lookup (user_id, answered_at IS NULL, newest sent_at first)
+        Index(
+            'ix_user_questions_pending', 'user_id', 'sent_at',
+            sqlite_where=text('answered_at IS NULL'),
+            postgresql_where=text('answered_at IS NULL')
+        ),
+        # Lets the "questions already sent to this user" lookup read ids straight from the index
+        Index('ix_user_questions_user_qid', 'user_id', 'question_id'),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
@@ -1,4 +1,6 @@
+import random
 import pandas as pd
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List
 import logging
@@ -9,8 +11,15 @@ logger = logging.getLogger(__name__)
 class QuestionManager:
     def __init__(self):
         self.questions_df = None
-        self.correct_answers_df = None
-        self.incorrect_answers_df = None
+        # Per-question lookups keyed by question_id, built once per load
+        self._question_by_id = {}
+        self._correct_by_id = {}
+        self._incorrect_by_id = {}
+        self._ids_by_topic = {}
+        self._distractor_pool = []
+        self.question_ids = []
+        # Memoized question dicts, cleared on every reload
+        self._cached_question = lru_cache(maxsize=4096)(self._build_question)
         self._load_questions()
 
     def _load_questions(self):
@@ -27,64 +36,84 @@ class QuestionManager:
             df = df.rename(columns={'id':'question_id', 'pregunta':'question_text', 'respuesta':'answer_text'})
             # Store question texts (unique)
             self.questions_df = df[['question_id','question_text']].drop_duplicates().reset_index(drop=True)
-            # Correct answers where alternativas==1
-            self.correct_answers_df = df[df['alternativas']==1][['question_id','answer_text']].reset_index(drop=True)
-            # Incorrect answers where alternativas==0
-            self.incorrect_answers_df = df[df['alternativas']==0][['question_id','answer_text']].reset_index(drop=True)
-            # Store AI commentary data
-            self.ai_data = {}
-            for item in data:
-                qid = item.get('id')
-                if qid not in self.ai_data:
-                    self.ai_data[qid] = {
-                        'answer_ai': item.get('answer_ai'),
-                        'discussion_ai': item.get('discussion_ai'),
-                        'justification_ai': item.get('justification_ai'),
-                        'source_ai': item.get('source_ai')
-                    }
+            # Correct answers where alternativas==1, incorrect where alternativas==0. Only needed to
+            # build the lookups below, so they are not kept around after loading.
+            correct_answers_df = df[df['alternativas']==1][['question_id','answer_text']]
+            incorrect_answers_df = df[df['alternativas']==0][['question_id','answer_text']]
+            # Store AI commentary data (first row per question, missing values as None)
+            ai_df = df.reindex(columns=['question_id', 'answer_ai', 'discussion_ai', 'justification_ai', 'source_ai'])
+            ai_df = ai_df.drop_duplicates('question_id').set_index('question_id')
+            self.ai_data = ai_df.astype(object).where(ai_df.notna(), None).to_dict('index')
+            # Index questions and answers by id so lookups don't scan the DataFrames
+            self._question_by_id = {
+                row.question_id: row._asdict()
+                for row in self.questions_df.drop_duplicates('question_id').itertuples(index=False)
+            }
+            self.question_ids = list(self._question_by_id)
+            first_correct = correct_answers_df.drop_duplicates('question_id')
+            self._correct_by_id = dict(zip(first_correct['question_id'], first_correct['answer_text']))
+            self._incorrect_by_id = incorrect_answers_df.groupby('question_id')['answer_text'].apply(list).to_dict()
+            # Distinct correct answers, used to pad questions with fewer than three incorrect options
+            self._distractor_pool = list(dict.fromkeys(self._correct_by_id.values()))
+            # The API payload currently has no topic field; keep the index empty rather than fail
+            if 'topic' in df.columns:
+                topics = df[['question_id', 'topic']].drop_duplicates('question_id')
+                self._ids_by_topic = topics.groupby('topic')['question_id'].apply(list).to_dict()
+            else:
+                self._ids_by_topic = {}
+            self._cached_question.cache_clear()
             logger.info(f"Fetched {len(self.questions_df)} questions from API")
         except Exception as e:
             logger.error(f"Error fetching questions from API: {e}")
             raise
 
     def get_question_by_id(self, question_id: int) -> Dict:
-        """Retrieve a question and its associated answers by ID"""
+        """Retrieve a question and its associated answers by ID (cached, treat the result as read-only)"""
         if self.questions_df is None:
             raise RuntimeError("Questions have not been loaded")
-            
-        question = self.questions_df[self.questions_df['question_id'] == question_id].to_dict('records')
-        if not question:
+        return self._cached_question(question_id)
+
+    def _build_question(self, question_id: int) -> Dict:
+        """Assemble the question dict for get_question_by_id"""
+        question = self._question_by_id.get(question_id)
+        if question is None:
             return None
-            
-        question = question[0]
-        
-        # Add correct answer
-        correct_answer = self.correct_answers_df[
-            self.correct_answers_df['question_id'] == question_id
-        ]['answer_text'].iloc[0] if not self.correct_answers_df.empty else None
         
-        # Add incorrect answers if available
-        incorrect_answers = self.incorrect_answers_df[
-            self.incorrect_answers_df['question_id'] == question_id
-        ]['answer_text'].tolist() if not self.incorrect_answers_df.empty else []
         # Include source from AI data if available
         ai_info = getattr(self, 'ai_data', {}).get(question_id, {})
         source = ai_info.get('source_ai')
 
         return {
             **question,
-            'correct_answer': correct_answer,
-            'incorrect_answers': incorrect_answers,
+            'correct_answer': self._correct_by_id.get(question_id),
+            'incorrect_answers': list(self._incorrect_by_id.get(question_id, [])),
             'source': source
         }
 
+    def sample_distractors(self, exclude: List[str], k: int) -> List[str]:
+        """
+        Pick k distinct answers from other questions to use as extra incorrect options.
+        
+        Args:
+            exclude: Answer texts that must not be returned (the correct and existing incorrect answers)
+            k: Number of distractors needed
+            
+        Returns:
+            Up to k answer texts, none of them in `exclude`
+        """
+        if k <= 0:
+            return []
+        excluded = set(exclude)
+        # Drawing k + len(excluded) distinct answers guarantees k survivors when the pool is large enough
+        size = min(len(self._distractor_pool), k + len(excluded))
+        picks = [answer for answer in random.sample(self._distractor_pool, size) if answer not in excluded]
+        return picks[:k]
+
     def get_questions_by_topic(self, topic: str) -> List[Dict]:
         """Retrieve all questions for a specific topic"""
         if self.questions_df is None:
             raise RuntimeError("Questions have not been loaded")
-            
-        questions = self.questions_df[self.questions_df['topic'] == topic].to_dict('records')
-        return [self.get_question_by_id(q['question_id']) for q in questions]
+        return [self.get_question_by_id(qid) for qid in self._ids_by_topic.get(topic, [])]
 
 # Create a singleton instance
 question_manager = QuestionManager()
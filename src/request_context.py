@@ -0,0 +1,29 @@
+import contextvars
+import itertools
+import logging
+from contextvars import ContextVar
+from typing import Any, Callable
+
+# Short id of the webhook request (or scheduled job) being handled, added to log records by RequestIdFilter
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+_request_counter = itertools.count(1)
+
+def new_request_id() -> str:
+    """Assign the next request id to the current context and return it"""
+    request_id = format(next(_request_counter) & 0xFFFFFF, 'x')
+    request_id_var.set(request_id)
+    return request_id
+
+def run_in_clean_context(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """
+    Call `func` in an empty context, so nothing it schedules inherits the caller's request id.
+    asyncio callbacks and tasks copy the current context, so e.g. a scheduler job added while
+    handling a webhook would otherwise log under that webhook's id when it runs hours later.
+    """
+    return contextvars.Context().run(func, *args, **kwargs)
+
+class RequestIdFilter(logging.Filter):
+    """Sets record.request_id, so formatters can use %(request_id)s instead of each call formatting it"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
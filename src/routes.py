@@ -1,22 +1,44 @@
 import logging
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List
 from . import crud, schemas, database
+from .models import UserState
+from .scheduler import scheduler, schedule_next_question, forget_seen_question_ids
+from .message_handler import contact_uncontacted_users
+from .active_users import active_user_manager
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/users", tags=["users"])
 
+# Largest page GET /users/ returns; larger limits are clamped (use /users/stream for everything)
+MAX_PAGE_SIZE = 1000
+
 @router.get("/", response_model=List[schemas.User])
 def read_users(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1),
     db: Session = Depends(database.get_db)
 ):
-    users = crud.get_users(db, skip=skip, limit=limit)
+    users = crud.get_users(db, skip=skip, limit=min(limit, MAX_PAGE_SIZE))
     return users
 
+@router.get("/stream")
+def stream_users():
+    """
+    Export every user as newline-delimited JSON, one object per line.
+    Rows are fetched in batches, so memory use stays flat however many users there are.
+    """
+    def generate():
+        # Own session: the stream outlives the request's dependency scope
+        with database.SessionLocal() as db:
+            for user in crud.iter_users(db):
+                yield schemas.User.model_validate(user).model_dump_json() + "\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
 @router.post("/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(database.get_db)):
     db_user = crud.get_user_by_phone(db, phone_number=user.phone_number)
@@ -31,28 +53,39 @@ def read_user(user_id: int, db: Session = Depends(database.get_db)):
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
+# User fields that determine whether and when the question confirmation job runs
+SCHEDULE_FIELDS = ("scheduled_day_of_week", "scheduled_hour", "scheduled_minute", "phone_number", "state")
+
+def _schedule_snapshot(user) -> tuple:
+    return tuple(getattr(user, field) for field in SCHEDULE_FIELDS)
+
 @router.put("/{user_id}", response_model=schemas.User)
 def update_user(
     user_id: int,
     user: schemas.UserUpdate,
     db: Session = Depends(database.get_db)
 ):
+    # Snapshot the fields the question job depends on, to skip rescheduling unrelated edits
+    existing_user = crud.get_user(db, user_id=user_id)
+    if existing_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    schedule_before = _schedule_snapshot(existing_user)
+    
     db_user = crud.update_user(db=db, user_id=user_id, user=user)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    # Reschedule question job if schedule or phone changed
-    from .scheduler import scheduler, schedule_next_question
-    from .active_users import active_user_manager
-    from .models import UserState
+    if _schedule_snapshot(db_user) == schedule_before:
+        return db_user
+    # Reschedule question job if schedule or phone changed; add_job(replace_existing=True)
+    # overwrites any existing job, so it only needs removing when nothing is scheduled
+    if db_user.state == UserState.SUBSCRIBED and active_user_manager.is_active(db_user.phone_number):
+        if schedule_next_question(db_user, db) is not None:
+            return db_user
     job_id = f"question_confirmation_{db_user.id}"
-    # Remove any existing job
     try:
         scheduler.remove_job(job_id)
     except Exception:
         pass
-    # Schedule a new job only if user is active and subscribed
-    if db_user.state == UserState.SUBSCRIBED and active_user_manager.is_active(db_user.phone_number):
-        schedule_next_question(db_user, db)
     return db_user
 
 @router.delete("/{user_id}")
@@ -60,8 +93,8 @@ def delete_user(user_id: int, db: Session = Depends(database.get_db)):
     success = crud.delete_user(db=db, user_id=user_id)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
-    # Remove scheduled job for deleted user
-    from .scheduler import scheduler
+    # Remove scheduled job and cached question history for deleted user
+    forget_seen_question_ids(user_id)
     job_id = f"question_confirmation_{user_id}"
     try:
         scheduler.remove_job(job_id)
@@ -71,7 +104,7 @@ def delete_user(user_id: int, db: Session = Depends(database.get_db)):
 
 @router.post("/contact", response_model=dict)
 async def contact_users(
-    limit: int = Query(10, description="Maximum number of users to contact"),
+    limit: int = Query(10, ge=1, description="Maximum number of users to contact"),
     db: Session = Depends(database.get_db)
 ):
     """
@@ -85,69 +118,58 @@ async def contact_users(
     Returns:
         Dict with contact results
     """
-    from .message_handler import whatsapp_client, handle_uncontacted_user
-    from .models import UserState
-    from .active_users import active_user_manager # Import active user manager
-    import asyncio
+    User = crud.models.User
     
-    # Get users in UNCONTACTED state
-    users = db.query(crud.models.User).filter(
-        crud.models.User.state == UserState.UNCONTACTED
-    ).limit(limit).all()
+    # Pick the first `limit` UNCONTACTED users whose number is active, reading only id and phone
+    # so inactive numbers never fill the batch. Rows are streamed in chunks, so the loop below
+    # stops reading once the batch is full
+    active_numbers = active_user_manager.active_phone_numbers()
+    candidates = db.query(User.id, User.phone_number).filter(
+        User.state == UserState.UNCONTACTED
+    ).order_by(User.id).yield_per(500)
     
-    if not users:
+    user_ids = []
+    skipped_inactive = 0 # Inactive users passed over while filling the batch
+    for user_id, phone_number in candidates:
+        if len(user_ids) >= limit:
+            break
+        if phone_number not in active_numbers:
+            skipped_inactive += 1
+            continue
+        user_ids.append(user_id)
+    
+    if not user_ids:
         return {"status": "no_users", "contacted": 0}
     
+    users = db.query(User).filter(User.id.in_(user_ids)).order_by(User.id).all()
+    
     success_count = 0
     failed_count = 0
-    skipped_inactive = 0 # Counter for skipped inactive users
     results = []
     
-    # Contact each user
-    for user in users:
-        # Check if user is active before contacting
-        if not active_user_manager.is_active(user.phone_number):
-            logger.info(f"Skipping contact for inactive user: {user.phone_number}")
+    # Contact active users concurrently; contact_uncontacted_users manages state changes internally
+    contact_results = await contact_uncontacted_users(db, users)
+    
+    for user, contact_result in zip(users, contact_results):
+        if isinstance(contact_result, Exception):
+            logger.error(f"Error contacting user {user.phone_number}: {str(contact_result)}", exc_info=contact_result)
             results.append({
                 "phone_number": user.phone_number,
-                "status": "skipped",
-                "reason": "inactive_user"
+                "status": "error",
+                "reason": str(contact_result)
             })
-            skipped_inactive += 1
-            continue # Skip to the next user
-            
-        try:
-            # Use the handle_uncontacted_user method to manage user contact
-            # Pass the user object directly
-            contact_result = await handle_uncontacted_user(db, user, {})
-            
-            # handle_uncontacted_user now manages state changes internally
-            # Check the result status
-            if contact_result.get("status") == "success":
-                 results.append({
-                    "phone_number": user.phone_number,
-                    "status": "success"
-                })
-                 success_count += 1
-            else:
-                results.append({
-                    "phone_number": user.phone_number,
-                    "status": "failed",
-                    "reason": contact_result.get("reason", "unknown_error")
-                })
-                failed_count += 1
-            
-            # Small delay between users
-            await asyncio.sleep(1) # Reduced delay slightly
-            
-        except Exception as e:
-            # Rollback might not be needed if handle_uncontacted_user handles its own session/errors
-            # db.rollback() 
-            logger.error(f"Error contacting user {user.phone_number}: {str(e)}", exc_info=True)
+            failed_count += 1
+        elif contact_result.get("status") == "success":
             results.append({
                 "phone_number": user.phone_number,
-                "status": "error",
-                "reason": str(e)
+                "status": "success"
+            })
+            success_count += 1
+        else:
+            results.append({
+                "phone_number": user.phone_number,
+                "status": "failed",
+                "reason": contact_result.get("reason", "unknown_error")
             })
             failed_count += 1
     
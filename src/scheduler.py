@@ -1,35 +1,67 @@
+import contextvars
 import logging
+import os
 import random # Add random import
 import string # Add string import
-import pytz
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional
-from sqlalchemy.orm import Session
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from typing import Dict, Any, List, Optional, Tuple
+from sqlalchemy import update
+from sqlalchemy.orm import Session, load_only
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.base import STATE_RUNNING
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 # Use AsyncIOExecutor instead of ThreadPoolExecutor for async jobs
 from apscheduler.executors.asyncio import AsyncIOExecutor 
 
 # Import SessionLocal for creating sessions within jobs
-from .database import SessionLocal 
+from .database import SessionLocal, create_pooled_engine
 from .models import User, UserState, UserQuestion
-from .whatsapp import WhatsAppClient
+from .whatsapp import whatsapp_client
+from .request_context import request_id_var, run_in_clean_context
 from .questions import question_manager
 from .active_users import active_user_manager
-# Import the handler for uncontacted users
-from .message_handler import handle_uncontacted_user 
+# Import the module rather than its names so the handler <-> scheduler import cycle resolves in any order
+from . import message_handler
 import asyncio # Import asyncio for delays
 
 logger = logging.getLogger(__name__)
-whatsapp_client = WhatsAppClient()
 
 # Setup timezone for Lima, Peru (UTC-5)
-LIMA_TZ = pytz.timezone('America/Lima')
+LIMA_TZ = ZoneInfo('America/Lima')
 
-# Create job stores for persistent scheduling
-jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///scheduler.sqlite')
-}
+# Fixed text of the interactive question message
+QUESTION_HEADER = "Pregunta Médica"
+QUESTION_FOOTER = "Selecciona la letra de la respuesta correcta."
+QUESTION_BUTTON = "Ver Opciones"
+QUESTION_SECTION_TITLE = "Selecciona la letra"
+# Option letters, indexed by answer position
+ANSWER_LETTERS = string.ascii_uppercase
+
+@lru_cache(maxsize=4096)
+def _row_description(answer: str) -> str:
+    """Answer text as a list row description, truncated to fit WhatsApp's 72 char limit"""
+    return (answer[:70] + '..') if len(answer) > 72 else answer
+
+# Keep jobs in memory by default: every per-user job is derived from the users table,
+# which start_scheduler replays on startup and resync_user_jobs re-applies periodically.
+# Set SCHEDULER_DB_URL (e.g. a Postgres URL) to persist jobs through a pooled engine instead.
+SCHEDULER_DB_URL = os.getenv("SCHEDULER_DB_URL")
+if SCHEDULER_DB_URL:
+    # A regular pool, also for SQLite: besides the event loop, the job store is used from
+    # FastAPI's threadpool (sync routes) and from sync jobs run in executor threads, so a
+    # single shared connection is not safe. Pooled connections are still reused across
+    # operations, and create_pooled_engine sets check_same_thread=False for SQLite
+    jobstore_engine = create_pooled_engine(SCHEDULER_DB_URL, pool_size=10, max_overflow=20)
+    jobstores = {
+        'default': SQLAlchemyJobStore(engine=jobstore_engine)
+    }
+else:
+    jobstores = {
+        'default': MemoryJobStore()
+    }
 
 # Create executors - Use AsyncIOExecutor for async functions
 executors = {
@@ -43,6 +75,195 @@ scheduler = AsyncIOScheduler(
     timezone=LIMA_TZ
 )
 
+# Question ids already sent to each user, bulk-loaded at startup and kept up to
+# date by send_random_question, so sends don't re-read the history
+_seen_question_ids: Dict[int, set] = {}
+# Set once load_seen_question_ids has run; a user missing from the cache then has no history
+_seen_question_ids_loaded = False
+
+def _normalize_question_id(qid):
+    """Older rows may hold the question id as a little-endian blob, normalize those to int"""
+    return int.from_bytes(qid, 'little') if isinstance(qid, (bytes, bytearray)) else qid
+
+def load_seen_question_ids(db: Session):
+    """
+    Load the question history of every user in a single query.
+    
+    Args:
+        db: Database session
+    """
+    global _seen_question_ids_loaded
+    seen_by_user: Dict[int, set] = {}
+    for user_id, qid in db.query(UserQuestion.user_id, UserQuestion.question_id):
+        seen_by_user.setdefault(user_id, set()).add(_normalize_question_id(qid))
+    _seen_question_ids.clear()
+    _seen_question_ids.update(seen_by_user)
+    _seen_question_ids_loaded = True
+    logger.info(f"Loaded question history for {len(seen_by_user)} users")
+
+def get_seen_question_ids(db: Session, user_id: int) -> set:
+    """
+    Return the (mutable, cached) set of question ids already sent to a user.
+    
+    Args:
+        db: Database session, only queried if the history was not bulk-loaded
+        user_id: ID of the user
+    """
+    seen = _seen_question_ids.get(user_id)
+    if seen is None:
+        if _seen_question_ids_loaded:
+            seen = set()
+        else:
+            # Read from the (user_id, question_id) index
+            seen = {
+                _normalize_question_id(qid)
+                for (qid,) in db.query(UserQuestion.question_id).filter(UserQuestion.user_id == user_id)
+            }
+        _seen_question_ids[user_id] = seen
+    return seen
+
+def forget_seen_question_ids(user_id: int):
+    """Drop the cached question history of a user (e.g. when the user is deleted)"""
+    _seen_question_ids.pop(user_id, None)
+
+# Random draws tried before falling back to filtering the full id list
+UNSEEN_PICK_ATTEMPTS = 8
+
+def pick_unseen_question_id(question_ids: List[int], seen: set) -> Optional[int]:
+    """
+    Pick a uniformly random question id that is not in `seen`.
+    
+    Rejection sampling keeps this O(1) while most questions are unseen (the usual case);
+    only users who have seen most of the catalog pay for a scan of the id list.
+    
+    Args:
+        question_ids: All available question ids
+        seen: Question ids already sent to the user
+        
+    Returns:
+        An unseen question id, or None if every question has been seen
+    """
+    # Users with no history (every first send) can take any question
+    if not seen:
+        return random.choice(question_ids)
+    for _ in range(UNSEEN_PICK_ATTEMPTS):
+        question_id = random.choice(question_ids)
+        if question_id not in seen:
+            return question_id
+    available_ids = [qid for qid in question_ids if qid not in seen]
+    return random.choice(available_ids) if available_ids else None
+
+class SendLimiter:
+    """
+    Bounds the start rate of WhatsApp sends from scheduled jobs to `rate` requests
+    per second (token bucket), so jobs firing at the same minute overlap their HTTP
+    round trips without bursting past the API throughput limit. The number of
+    requests in flight is capped by the WhatsApp client itself.
+    """
+    def __init__(self, rate: float = 80):
+        self.rate = rate
+        self._tokens = rate
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+
+    async def _take_token(self):
+        """Wait until a token is available in the bucket and consume it"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated_at is not None:
+                    self._tokens = min(self.rate, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def __aenter__(self):
+        await self._take_token()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+send_limiter = SendLimiter()
+
+class StateTransitionBatcher:
+    """
+    Coalesces user state changes requested within a short window into one
+    UPDATE per (expected state, new state) pair and a single commit. Used by jobs
+    that fire for many users at the same minute, so they share one write transaction.
+    """
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        # (expected state, new state) -> [(user id, waiter)]
+        self._pending: Dict[Tuple[int, int], List[Tuple[int, asyncio.Future]]] = {}
+        self._flush_handle = None
+        self._flush_tasks = set() # Strong references to running flushes
+
+    async def set_state(self, user_id: int, state: UserState, expected_state: UserState) -> bool:
+        """
+        Queue a conditional state change and wait until the batch containing it is committed.
+        
+        Args:
+            user_id: ID of the user to update
+            state: New state for the user
+            expected_state: State the user must still be in for the change to apply
+            
+        Returns:
+            bool: True if the user's row was changed, False if its state had moved on
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._pending.setdefault((expected_state, state), []).append((user_id, waiter))
+        if self._flush_handle is None:
+            # Empty context: the flush serves many jobs and should not log under the first one's id
+            self._flush_handle = loop.call_later(self.delay, self._start_flush, context=contextvars.Context())
+        return await waiter
+
+    def _start_flush(self):
+        """Hand the queued changes to a flush task, leaving the batcher free for the next window"""
+        pending = self._pending
+        self._pending, self._flush_handle = {}, None
+        task = asyncio.ensure_future(self._flush(pending))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self, pending: Dict[Tuple[int, int], List[Tuple[int, asyncio.Future]]]):
+        """Write the queued state changes and resolve each waiter with whether its row changed"""
+        waiters = [(user_id, waiter) for entries in pending.values() for user_id, waiter in entries]
+        try:
+            # The commit can wait on SQLite's busy_timeout, so keep it off the event loop
+            changed_ids = await asyncio.to_thread(self._write, pending)
+        except Exception as e:
+            for _, waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            return
+        for user_id, waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(user_id in changed_ids)
+
+    @staticmethod
+    def _write(pending: Dict[Tuple[int, int], List[Tuple[int, asyncio.Future]]]) -> set:
+        """Run one UPDATE per state pair in a single transaction, returning the ids actually changed"""
+        changed_ids = set()
+        with SessionLocal() as db:
+            for (expected_state, state), entries in pending.items():
+                user_ids = [user_id for user_id, _ in entries]
+                result = db.execute(
+                    update(User)
+                    .where(User.id.in_(user_ids), User.state == expected_state)
+                    .values(state=state)
+                    .returning(User.id)
+                )
+                changed_ids.update(result.scalars())
+            db.commit()
+        return changed_ids
+
+state_batcher = StateTransitionBatcher()
+
 async def send_question_confirmation(user_id: int):
     """
     Send a confirmation template to ask if the user wants to receive a question now.
@@ -51,11 +272,13 @@ async def send_question_confirmation(user_id: int):
     Args:
         user_id: ID of the user to send confirmation to
     """
+    # Tag this job's log records with the job id
+    request_id_var.set(f"question_confirmation_{user_id}")
     logger.info(f"Job started: Sending question confirmation for user_id {user_id}")
     try:
         with SessionLocal() as db: # Create a new session for this job
             # Get the user
-            user = db.query(User).filter(User.id == user_id).first()
+            user = db.get(User, user_id)
             if not user:
                 logger.error(f"User with ID {user_id} not found in job")
                 return
@@ -67,18 +290,26 @@ async def send_question_confirmation(user_id: int):
                  # schedule_next_question(user, db) # Reschedule if needed, passing the new db session
                  return
 
-            logger.info(f"Sending question confirmation to user {user.phone_number} (ID: {user_id})")
-            
-            # Update user state
-            user.state = UserState.AWAITING_QUESTION_CONFIRMATION
-            db.commit()
-            
-            # Send confirmation template
+            phone_number = user.phone_number
+
+        logger.info(f"Sending question confirmation to user {phone_number} (ID: {user_id})")
+        
+        # Update user state, batched with other confirmations firing at the same time.
+        # Waits for the commit, so the reply always finds the user in the new state; the
+        # update only applies if the user is still SUBSCRIBED when the batch is written.
+        if not await state_batcher.set_state(
+            user_id, UserState.AWAITING_QUESTION_CONFIRMATION, expected_state=UserState.SUBSCRIBED
+        ):
+            logger.warning(f"User {phone_number} (ID: {user_id}) left SUBSCRIBED state before the confirmation was recorded. Skipping confirmation.")
+            return
+        
+        # Send confirmation template
+        async with send_limiter:
             await whatsapp_client.send_template_message(
-                to_number=user.phone_number,
+                to_number=phone_number,
                 template_name="confirmacion_pregunta"
             )
-            logger.info(f"Successfully sent confirmation template to user {user.phone_number} (ID: {user_id})")
+        logger.info(f"Successfully sent confirmation template to user {phone_number} (ID: {user_id})")
 
     except Exception as e:
         logger.error(f"Error in send_question_confirmation job for user_id {user_id}: {e}", exc_info=True)
@@ -87,7 +318,8 @@ async def send_question_confirmation(user_id: int):
 async def send_random_question(user_id: int):
     """
     Send a random question to the user that they haven't answered before.
-    Creates its own database session.
+    Creates its own database session, closed before the send so no connection is held
+    while waiting on WhatsApp.
     
     Args:
         user_id: ID of the user to send question to
@@ -96,111 +328,77 @@ async def send_random_question(user_id: int):
     try:
         with SessionLocal() as db: # Create a new session for this job
             # Get the user
-            user = db.query(User).filter(User.id == user_id).first()
+            user = db.get(User, user_id)
             if not user:
                 logger.error(f"User with ID {user_id} not found in job")
                 return
-            
-            # Get all previously sent question IDs for this user
-            previous_questions = db.query(UserQuestion.question_id).filter(
-                UserQuestion.user_id == user_id
-            ).all()
-            previous_question_ids = [q[0] for q in previous_questions]
+            phone_number = user.phone_number
             
             # Get a random question that the user hasn't seen
-            all_questions = question_manager.questions_df
+            all_question_ids = question_manager.question_ids
             
-            if all_questions is None or all_questions.empty:
+            if not all_question_ids:
                 logger.error("No questions available in the database")
-                await whatsapp_client.send_text_message(
-                    to_number=user.phone_number,
-                    message_text="Lo siento, no hay preguntas disponibles en este momento."
-                )
+                db.close()
+                async with send_limiter:
+                    await whatsapp_client.send_text_message(
+                        to_number=phone_number,
+                        message_text="Lo siento, no hay preguntas disponibles en este momento."
+                    )
                 return
             
-            # If all questions have been answered, allow repeating
-            available_questions = all_questions
-            if previous_question_ids and len(previous_question_ids) < len(all_questions):
-                available_questions = all_questions[~all_questions['question_id'].isin(previous_question_ids)]
+            # Previously sent question IDs (cached in-process after the first send)
+            seen_question_ids = get_seen_question_ids(db, user_id)
             
-            if available_questions.empty:
-                logger.info(f"User {user.phone_number} has answered all questions, resetting")
-                available_questions = all_questions
+            # Get a random unseen question; if all questions have been answered, allow repeating
+            question_id = pick_unseen_question_id(all_question_ids, seen_question_ids)
+            if question_id is None:
+                logger.info(f"User {phone_number} has answered all questions, resetting")
+                question_id = random.choice(all_question_ids)
+            question = question_manager.get_question_by_id(question_id)
+            question_text = question['question_text']
             
-            # Get a random question
-            question_row = available_questions.sample(n=1).iloc[0]
-            question_id = question_row['question_id']
-            question_text = question_row['question_text']
-            
-            # Get correct answer
-            correct_answer = question_manager.correct_answers_df[
-                question_manager.correct_answers_df['question_id'] == question_id
-            ]['answer_text'].values[0]
-            
-            # Get incorrect answers
-            incorrect_answers = []
-            try:
-                incorrect_answers = question_manager.incorrect_answers_df[
-                    question_manager.incorrect_answers_df['question_id'] == question_id
-                ]['answer_text'].tolist()
-            except Exception as e:
-                logger.warning(f"Could not retrieve incorrect answers: {str(e)}")
+            # Get correct and incorrect answers from the pre-indexed question data
+            correct_answer = question['correct_answer']
+            if correct_answer is None:
+                logger.error(f"No correct answer found for question {question_id}")
+                return
+            # Copy: the cached question dict is shared between jobs
+            incorrect_answers = list(question['incorrect_answers'])
             
-            # If not enough incorrect answers, generate some
-            while len(incorrect_answers) < 3:
-                # Get a random correct answer from another question
-                random_answer = question_manager.correct_answers_df[
-                    question_manager.correct_answers_df['question_id'] != question_id
-                ].sample(n=1)['answer_text'].values[0]
-                
-                if random_answer not in incorrect_answers and random_answer != correct_answer:
-                    incorrect_answers.append(random_answer)
+            # If not enough incorrect answers, borrow correct answers from other questions
+            incorrect_answers += question_manager.sample_distractors(
+                exclude=[correct_answer] + incorrect_answers,
+                k=3 - len(incorrect_answers)
+            )
             
-            # Combine and shuffle all answers
-            all_answers = [correct_answer] + incorrect_answers
-            random.shuffle(all_answers)
+            # Shuffle the incorrect answers and drop the correct one in at a random position,
+            # so its letter is known without searching (and duplicates can't confuse it)
+            all_answers = random.sample(incorrect_answers, len(incorrect_answers))
+            correct_index = random.randrange(len(all_answers) + 1)
+            all_answers.insert(correct_index, correct_answer)
             
             # Assign letters (A, B, C...) and build message body
-            message_body_parts = [question_text]
-            answer_map = {} # To store letter -> answer text and find correct letter
-            letters = list(string.ascii_uppercase[:len(all_answers)]) # Get letters A, B, C... up to the number of answers
-            
-            for i, answer in enumerate(all_answers):
-                letter = letters[i]
-                answer_map[letter] = answer
-                # Use single backslash for actual newline
-                message_body_parts.append(f"\n{letter}. {answer}") 
-                
-            # Join with single backslash for actual newline
-            final_message_body = "\n".join(message_body_parts)
-            
-            # Find the letter corresponding to the correct answer
-            correct_answer_letter = None
-            for letter, text in answer_map.items():
-                if text == correct_answer:
-                    correct_answer_letter = letter
-                    break
+            letters = ANSWER_LETTERS[:len(all_answers)] # Get letters A, B, C... up to the number of answers
+            lettered_answers = list(zip(letters, all_answers)) # (letter, answer text) pairs
+            correct_answer_letter = letters[correct_index]
+            # Use single backslash for actual newline
+            final_message_body = "\n".join([question_text, *(f"\n{letter}. {answer}" for letter, answer in lettered_answers)])
             
-            if not correct_answer_letter:
-                 logger.error(f"Could not find correct answer letter for question {question_id}")
-                 # Handle error appropriately, maybe skip sending
-                 return
-
-            # Create section rows for the interactive list using letters
-            rows = []
-            for letter in letters:
-                answer_text = answer_map[letter]
-                # Truncate description to 72 chars
-                description = (answer_text[:70] + '..') if len(answer_text) > 72 else answer_text
-                rows.append({
-                    "id": letter, # Use the letter as the ID
-                    "title": letter, # Show the letter as the title
-                    "description": description
-                })
+            # Create section rows for the interactive list using letters as id and title,
+            # with the answer truncated to 72 chars as the description
+            rows = [
+                {
+                    "id": letter,
+                    "title": letter,
+                    "description": _row_description(answer)
+                }
+                for letter, answer in lettered_answers
+            ]
             
             # Create the section for the interactive list
             section = {
-                "title": "Selecciona la letra", # Updated title
+                "title": QUESTION_SECTION_TITLE,
                 "rows": rows
             }
             
@@ -218,49 +416,42 @@ async def send_random_question(user_id: int):
             # Update user state
             user.state = UserState.AWAITING_QUESTION_RESPONSE
             db.commit()
+            db.close()
+            seen_question_ids.add(question_id)
             
-            logger.info(f"Sending question to user {user.phone_number} (ID: {user_id}): question_id={question_id}")
+            logger.info(f"Sending question to user {phone_number} (ID: {user_id}): question_id={question_id}")
             
             # Send the question using the modified body and sections
-            await whatsapp_client.send_interactive_list_message(
-                to_number=user.phone_number,
-                header_text="Pregunta Médica",
-                body_text=final_message_body, # Use the body with question and lettered answers
-                footer_text="Selecciona la letra de la respuesta correcta.", # Updated footer
-                button_text="Ver Opciones",
-                sections=[section]
-            )
-            logger.info(f"Successfully sent question to user {user.phone_number} (ID: {user_id})")
+            async with send_limiter:
+                await whatsapp_client.send_interactive_list_message(
+                    to_number=phone_number,
+                    header_text=QUESTION_HEADER,
+                    body_text=final_message_body, # Use the body with question and lettered answers
+                    footer_text=QUESTION_FOOTER,
+                    button_text=QUESTION_BUTTON,
+                    sections=[section]
+                )
+            logger.info(f"Successfully sent question to user {phone_number} (ID: {user_id})")
 
     except Exception as e:
         logger.error(f"Error in send_random_question job for user_id {user_id}: {e}", exc_info=True)
 
 
-def schedule_next_question(user: User, db: Session):
+def compute_next_run_time(user: User, now: Optional[datetime] = None) -> datetime:
     """
-    Schedule the next question confirmation for a user based on their preferences.
-    Uses the provided session `db` to read user data for scheduling, 
-    but the job itself (`send_question_confirmation`) will create its own session.
+    Compute the next Lima-time occurrence of the user's weekly schedule.
+    Pure function: it neither touches the session nor the scheduler.
     
     Args:
-        user: User model instance (read from the calling context's session)
-        db: Database session (from the calling context, used only for reading user data)
+        user: User with scheduled_day_of_week, scheduled_hour and scheduled_minute set
+        now: Current Lima time; batch callers read the clock once and pass it in
+        
+    Returns:
+        Timezone-aware datetime of the next scheduled question confirmation
     """
-    # Ensure user object is up-to-date within the session if needed
-    db.refresh(user) 
-    
-    # --- Add state check --- 
-    if user.state != UserState.SUBSCRIBED:
-        logger.warning(f"User {user.phone_number} (ID: {user.id}) is not in SUBSCRIBED state ({user.state}). Skipping scheduling.")
-        return None
-    # --- End state check ---
-    
-    if user.scheduled_day_of_week is None or user.scheduled_hour is None:
-        logger.warning(f"User {user.phone_number} (ID: {user.id}) has no schedule set. Skipping scheduling.")
-        return None
-
     # Calculate the next scheduled time
-    now = datetime.now(LIMA_TZ)
+    if now is None:
+        now = datetime.now(LIMA_TZ)
     scheduled_day = user.scheduled_day_of_week
     scheduled_hour = user.scheduled_hour
     scheduled_minute = user.scheduled_minute # Get the minute
@@ -271,30 +462,59 @@ def schedule_next_question(user: User, db: Session):
         days_ahead += 7
     elif days_ahead == 0: # Target day is today
         # Check if the time has already passed today
-        current_time_in_lima = now.time()
-        target_time = datetime.min.time().replace(hour=scheduled_hour, minute=scheduled_minute)
-        if current_time_in_lima >= target_time:
+        if (now.hour, now.minute) >= (scheduled_hour, scheduled_minute):
             days_ahead += 7 # Schedule for next week if time already passed today
             
-    # Create the scheduled datetime in the correct timezone
+    # Create the scheduled datetime directly in the correct timezone
     next_date = now.date() + timedelta(days=days_ahead)
-    # Combine date with scheduled hour and minute
-    next_run_time_naive = datetime.combine(next_date, datetime.min.time().replace(hour=scheduled_hour, minute=scheduled_minute))
-    next_run_time = LIMA_TZ.localize(next_run_time_naive)
+    next_run_time = datetime(
+        next_date.year, next_date.month, next_date.day,
+        scheduled_hour, scheduled_minute, tzinfo=LIMA_TZ
+    )
     
     # This check might be redundant now due to the days_ahead logic, but keep for safety
     if next_run_time < now:
         logger.warning(f"Calculated next_run_time {next_run_time} is in the past compared to {now}. Adding 7 days.")
         next_run_time += timedelta(days=7)
     
+    return next_run_time
+
+def schedule_next_question(user: User, db: Session, now: Optional[datetime] = None):
+    """
+    Schedule the next question confirmation for a user based on their preferences.
+    Uses the provided session `db` to read user data for scheduling, 
+    but the job itself (`send_question_confirmation`) will create its own session.
+    
+    Args:
+        user: User model instance (read from the calling context's session)
+        db: Database session (from the calling context, used only for reading user data)
+        now: Current Lima time, defaults to reading the clock
+    """
+    # No refresh: callers pass a user attached to `db`, and attributes expired by their
+    # last commit are reloaded on first access anyway
+    
+    # --- Add state check --- 
+    if user.state != UserState.SUBSCRIBED:
+        logger.warning(f"User {user.phone_number} (ID: {user.id}) is not in SUBSCRIBED state ({user.state}). Skipping scheduling.")
+        return None
+    # --- End state check ---
+    
+    if user.scheduled_day_of_week is None or user.scheduled_hour is None:
+        logger.warning(f"User {user.phone_number} (ID: {user.id}) has no schedule set. Skipping scheduling.")
+        return None
+
+    next_run_time = compute_next_run_time(user, now)
+    
     logger.info(f"Scheduling next question confirmation for user {user.phone_number} (ID: {user.id}) at {next_run_time}")
     
     # Schedule the job
     job_id = f"question_confirmation_{user.id}"
             
-    # Add new job - Pass only the user_id, not the db session
+    # Add new job - Pass only the user_id, not the db session. Added from a clean context:
+    # this often runs while handling a webhook, and the job must not inherit its request id
     try:
-        scheduler.add_job(
+        run_in_clean_context(
+            scheduler.add_job,
             send_question_confirmation, # The async function to call
             'date',
             run_date=next_run_time,
@@ -334,33 +554,29 @@ async def contact_uncontacted_users_job():
 
             logger.info(f"Found {processed_count} users in UNCONTACTED state. Checking activity and contacting...")
 
+            users_to_contact = []
             for user in uncontacted_users:
                 # Check if user is active before contacting
                 if not active_user_manager.is_active(user.phone_number):
                     logger.info(f"Skipping contact for inactive uncontacted user: {user.phone_number}")
                     skipped_inactive += 1
                     continue # Skip to the next user
-                
-                try:
-                    # Reuse the handler function used by the route
-                    # Pass the user object and an empty dict for message context
-                    contact_result = await handle_uncontacted_user(db, user, {}) 
-                    
-                    # Check the result status (handle_uncontacted_user manages state changes)
-                    if contact_result.get("status") == "success":
-                        success_count += 1
-                        logger.debug(f"Successfully contacted uncontacted user: {user.phone_number}")
-                    else:
-                        failed_count += 1
-                        logger.warning(f"Failed to contact uncontacted user {user.phone_number}: {contact_result.get('reason', 'unknown')}")
-                    
-                    # Small delay between users to avoid rate limiting
-                    await asyncio.sleep(1) 
-                    
-                except Exception as e:
-                    # Log error for this specific user but continue with others
-                    logger.error(f"Error contacting uncontacted user {user.phone_number}: {str(e)}", exc_info=True)
+                users_to_contact.append(user)
+            
+            # Reuse the handler used by the route, with bounded concurrency
+            contact_results = await message_handler.contact_uncontacted_users(db, users_to_contact)
+            
+            for user, contact_result in zip(users_to_contact, contact_results):
+                if isinstance(contact_result, Exception):
+                    # Log error for this specific user; the others were still contacted
+                    logger.error(f"Error contacting uncontacted user {user.phone_number}: {str(contact_result)}", exc_info=contact_result)
+                    failed_count += 1
+                elif contact_result.get("status") == "success":
+                    success_count += 1
+                    logger.debug(f"Successfully contacted uncontacted user: {user.phone_number}")
+                else:
                     failed_count += 1
+                    logger.warning(f"Failed to contact uncontacted user {user.phone_number}: {contact_result.get('reason', 'unknown')}")
         
         logger.info(f"Finished contacting uncontacted users. Total processed: {processed_count}, Success: {success_count}, Failed: {failed_count}, Skipped (inactive): {skipped_inactive}")
 
@@ -375,21 +591,77 @@ def schedule_all_users(db: Session):
     Args:
         db: Database session
     """
-    # Get all subscribed users
-    users = db.query(User).filter(User.state == UserState.SUBSCRIBED).all()
+    # Get all subscribed users, loading only the columns scheduling needs
+    users = db.query(User).options(
+        load_only(
+            User.id, User.phone_number, User.state,
+            User.scheduled_day_of_week, User.scheduled_hour, User.scheduled_minute
+        )
+    ).filter(User.state == UserState.SUBSCRIBED).all()
     
-    for user in users:
-        # Skip inactive numbers
-        if not active_user_manager.is_active(user.phone_number):
-            logger.info(f"Skipping scheduling for inactive user {user.phone_number}")
-            continue
-        try:
-            schedule_next_question(user, db)
-        except Exception as e:
-            logger.error(f"Error scheduling user {user.phone_number}: {str(e)}")
+    # One clock read for the whole batch
+    now = datetime.now(LIMA_TZ)
+    
+    # Pause while adding so the scheduler wakes up once for the whole batch instead of per job
+    was_running = scheduler.state == STATE_RUNNING
+    if was_running:
+        scheduler.pause()
+    try:
+        for user in users:
+            # Skip inactive numbers
+            if not active_user_manager.is_active(user.phone_number):
+                logger.info(f"Skipping scheduling for inactive user {user.phone_number}")
+                continue
+            try:
+                schedule_next_question(user, db, now)
+            except Exception as e:
+                logger.error(f"Error scheduling user {user.phone_number}: {str(e)}")
+    finally:
+        if was_running:
+            scheduler.resume()
     
     logger.info(f"Scheduled questions for {len(users)} users")
 
+async def resync_user_jobs():
+    """
+    Re-apply the users table to the per-user question jobs, so schedule edits made
+    outside the app are picked up. Creates its own database session.
+    
+    Runs on the event loop (async), like the jobs it manages, and only touches users
+    whose job is missing or set for a different time. A job that is due (run time at
+    or before now) is never replaced: computing the slot again inside its own minute
+    would push it to next week before it fires.
+    """
+    try:
+        now = datetime.now(LIMA_TZ)
+        existing = {job.id: job.next_run_time for job in scheduler.get_jobs()}
+        rescheduled = 0
+        with SessionLocal() as db:
+            users = db.query(User).options(
+                load_only(
+                    User.id, User.phone_number, User.state,
+                    User.scheduled_day_of_week, User.scheduled_hour, User.scheduled_minute
+                )
+            ).filter(User.state == UserState.SUBSCRIBED).all()
+            
+            for user in users:
+                if user.scheduled_day_of_week is None or user.scheduled_hour is None:
+                    continue
+                if not active_user_manager.is_active(user.phone_number):
+                    continue
+                job_id = f"question_confirmation_{user.id}"
+                current_run_time = existing.get(job_id)
+                if current_run_time is not None:
+                    if current_run_time <= now:
+                        continue # Due or firing, leave it alone
+                    if current_run_time == compute_next_run_time(user, now):
+                        continue # Already up to date
+                schedule_next_question(user, db, now)
+                rescheduled += 1
+        logger.info(f"Resynced user jobs: {rescheduled} of {len(users)} subscribed users rescheduled")
+    except Exception as e:
+        logger.error(f"Error resyncing user jobs: {e}", exc_info=True)
+
 def start_scheduler(db: Session):
     """
     Start the scheduler, schedule daily refreshes, and the initial contact jobs.
@@ -449,10 +721,21 @@ def start_scheduler(db: Session):
         )
         logger.info("Scheduled daily job to contact UNCONTACTED users for 12:05 PM Lima time")
 
-        # NOTE: Removed schedule_all_users(db) call from startup.
-        # Initial contact for SUBSCRIBED users is handled by 'contact_subscribed_users'.
-        # Initial contact for UNCONTACTED users is handled by 'contact_uncontacted_users'.
-        # Subsequent scheduling happens based on user interactions.
+        # Load every user's question history once, so question sends don't query it
+        load_seen_question_ids(db)
+        
+        # Jobs live in memory, so rebuild the per-user question jobs from the users table
+        schedule_all_users(db)
+        
+        # Periodically re-apply them so schedule edits made outside the app are picked up
+        scheduler.add_job(
+            resync_user_jobs,
+            'interval',
+            minutes=5,
+            id='resync_user_jobs',
+            replace_existing=True
+        )
+        logger.info("Scheduled user job resync every 5 minutes")
         
     else:
         logger.warning("Scheduler already running")
@@ -1,90 +1,85 @@
-from fastapi import APIRouter, Request, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Request, HTTPException, Depends, Header, Query, BackgroundTasks
 import logging
 import json
 from typing import Optional, Dict, Any
 
-from .database import get_db
-from .whatsapp import WhatsAppClient
+from .database import SessionLocal
+from .whatsapp import WhatsAppClient, get_whatsapp_client, LazyJson
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
-whatsapp_client = WhatsAppClient()
 
-@router.get("/webhook")
-async def verify_webhook(request: Request):
+@router.get("/webhook", response_model=int)
+async def verify_webhook(
+    hub_mode: str = Query(..., alias="hub.mode"),
+    hub_verify_token: str = Query(..., alias="hub.verify_token"),
+    hub_challenge: int = Query(..., alias="hub.challenge"),
+    whatsapp_client: WhatsAppClient = Depends(get_whatsapp_client)
+):
     """
     Verify webhook endpoint for WhatsApp Cloud API.
     This endpoint is called by WhatsApp when setting up the webhook.
-    Returns 403 if verification fails, 400 if parameters are missing/invalid.
+    Returns 403 if verification fails; FastAPI answers 422 if a parameter
+    is missing or hub.challenge is not numeric.
     """
+    logger.info(f"Received webhook verification request - mode: {hub_mode}, token: [REDACTED], challenge: {hub_challenge}")
+    
+    # Verify the token and mode
+    result = whatsapp_client.verify_webhook(
+        mode=hub_mode,
+        token=hub_verify_token,
+        challenge=str(hub_challenge)
+    )
+    
+    if result:
+        logger.info("Webhook verification successful")
+        return hub_challenge
+    
+    logger.warning("Webhook verification failed")
+    raise HTTPException(status_code=403, detail="Verification failed")
+
+async def process_message(processed_data: Dict[str, Any]):
+    """
+    Run the message handler for an already acknowledged webhook message.
+    Creates its own database session, since the request's session is closed by then.
+    
+    Args:
+        processed_data: Message information extracted by process_webhook_payload
+    """
+    from .message_handler import handle_message
     try:
-        logger.info("Received webhook verification request")
-        
-        # Get query parameters
-        params = request.query_params
-        hub_mode = params.get("hub.mode")
-        hub_verify_token = params.get("hub.verify_token")
-        hub_challenge = params.get("hub.challenge")
-        
-        # Validate required parameters
-        if not all([hub_mode, hub_verify_token, hub_challenge]):
-            missing_params = []
-            if not hub_mode:
-                missing_params.append("hub.mode")
-            if not hub_verify_token:
-                missing_params.append("hub.verify_token")
-            if not hub_challenge:
-                missing_params.append("hub.challenge")
-            
-            error_msg = f"Missing required parameters: {', '.join(missing_params)}"
-            logger.warning(error_msg)
-            raise HTTPException(status_code=400, detail=error_msg)
-        
-        # Validate challenge is numeric
-        try:
-            int(hub_challenge)
-        except ValueError:
-            error_msg = "hub.challenge must be numeric"
-            logger.warning(error_msg)
-            raise HTTPException(status_code=400, detail=error_msg)
-            
-        # Log parameters safely (after validation)
-        logger.info(
-            "Verification parameters - "
-            f"mode: {hub_mode}, "
-            "token: [REDACTED], "
-            f"challenge: {hub_challenge}"
-        )
-        
-        # Verify the token and mode
-        result = whatsapp_client.verify_webhook(
-            mode=hub_mode,
-            token=hub_verify_token,
-            challenge=hub_challenge
-        )
-        
-        if result:
-            logger.info("Webhook verification successful")
-            return int(hub_challenge)
-        
-        logger.warning("Webhook verification failed")
-        raise HTTPException(status_code=403, detail="Verification failed")
-        
+        with SessionLocal() as db:
+            result = await handle_message(db, processed_data)
+        logger.info("Message handling result: %s", LazyJson(result))
     except Exception as e:
-        logger.error(f"Error in webhook verification: {str(e)}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.error(f"Error handling webhook message: {str(e)}", exc_info=True)
 
 @router.post("/webhook")
-async def handle_webhook(request: Request, db: Session = Depends(get_db)):
+async def handle_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    whatsapp_client: WhatsAppClient = Depends(get_whatsapp_client),
+    x_hub_signature_256: Optional[str] = Header(None)
+):
     """
     Main webhook endpoint for receiving WhatsApp messages and updates.
     This endpoint handles all incoming messages and interactions from WhatsApp.
     """
+    # Get the raw payload once: the signature is computed over these exact bytes
+    raw = await request.body()
+    # Reject forged deliveries before any parsing
+    if not whatsapp_client.verify_signature(raw, x_hub_signature_256):
+        logger.warning("Rejecting webhook with invalid X-Hub-Signature-256")
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    
     try:
-        # Get the raw payload
-        body = await request.json()
-        logger.debug(f"Received webhook payload: {json.dumps(body)}")
+        # Delivery/read receipts vastly outnumber messages and never reach the handler,
+        # so acknowledge them from a bytes search without decoding the JSON
+        if b'"messages"' not in raw and b'"statuses"' in raw:
+            logger.debug("Acknowledging status-only webhook without parsing")
+            return {"status": "success", "type": "status_update"}
+        body = json.loads(raw)
+        logger.debug("Received webhook payload: %s", LazyJson(body))
         
         # Initial validation
         if not isinstance(body, dict):
@@ -107,12 +102,10 @@ async def handle_webhook(request: Request, db: Session = Depends(get_db)):
             logger.info(f"Message status update: {processed_data.get('status')} for message {processed_data.get('message_id')}")
             return {"status": "success", "type": "status_update"}
         
-        # Handle actual messages through the message handler
-        from .message_handler import handle_message
-        result = await handle_message(db, processed_data)
-        
-        logger.info(f"Message handling result: {json.dumps(result)}")
-        return {"status": "success", "result": result}
+        # Acknowledge now and handle the message after the response is sent, so slow
+        # handling (DB, outbound sends) never delays the 200 Meta waits for
+        background_tasks.add_task(process_message, processed_data)
+        return {"status": "queued"}
         
     except json.JSONDecodeError:
         logger.error("Failed to decode webhook payload")
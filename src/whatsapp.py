@@ -1,28 +1,113 @@
+import asyncio
 import httpx
 import os
 from dotenv import load_dotenv
 import json
 import logging
-import requests
-import uuid
-from typing import Dict, Any, Optional, List
+import weakref
+import hmac
+import hashlib
+from functools import lru_cache
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, List, Tuple
+
+from .request_context import new_request_id
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+class LazyJson:
+    """Defers json.dumps until a log record is actually emitted, e.g. logger.debug("%s", LazyJson(data))"""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj: Any):
+        self.obj = obj
+
+    def __str__(self) -> str:
+        return json.dumps(self.obj)
+
+# Fields shared by every outbound payload of each message type; sends merge in only the
+# per-message leaves, so these (shallow) dicts must never be mutated
+TEXT_MESSAGE_BASE = {
+    "messaging_product": "whatsapp",
+    "recipient_type": "individual",
+    "type": "text"
+}
+TEMPLATE_MESSAGE_BASE = {
+    "messaging_product": "whatsapp",
+    "recipient_type": "individual",
+    "type": "template"
+}
+INTERACTIVE_MESSAGE_BASE = {
+    "messaging_product": "whatsapp",
+    "recipient_type": "individual",
+    "type": "interactive"
+}
+
+@dataclass(frozen=True, slots=True)
+class WhatsAppSettings:
+    """WhatsApp Cloud API configuration, read from the environment once per process"""
+    # Phone number ID (not the display phone number)
+    phone_number_id: str
+    # WhatsApp Business Account ID
+    waba_id: str
+    # Access token
+    access_token: str
+    # Verify token for webhook
+    verify_token: str
+    # App secret used to check the X-Hub-Signature-256 header of webhook deliveries (optional)
+    app_secret: str
+    # Base URL for the WhatsApp Cloud API
+    api_url: str = "https://graph.facebook.com/v22.0"
+
+    @classmethod
+    def from_env(cls) -> "WhatsAppSettings":
+        return cls(
+            phone_number_id=os.getenv("WHATSAPP_PHONE_NUMBER_ID", ""),
+            waba_id=os.getenv("WHATSAPP_BUSINESS_ACCOUNT_ID", ""),
+            access_token=os.getenv("WHATSAPP_ACCESS_TOKEN", ""),
+            verify_token=os.getenv("WHATSAPP_VERIFY_TOKEN", "banquea_medical_bot_verify_token"),
+            app_secret=os.getenv("WHATSAPP_APP_SECRET", ""),
+        )
+
+@lru_cache(maxsize=1)
+def get_whatsapp_settings() -> WhatsAppSettings:
+    """Return the process-wide WhatsApp settings, reading the environment on first use"""
+    return WhatsAppSettings.from_env()
+
 class WhatsAppClient:
-    def __init__(self):
-        # Phone number ID (not the display phone number)
-        self.phone_number_id = os.getenv("WHATSAPP_PHONE_NUMBER_ID", "")
-        # WhatsApp Business Account ID
-        self.waba_id = os.getenv("WHATSAPP_BUSINESS_ACCOUNT_ID", "")
-        # Base URL for the WhatsApp Cloud API
-        self.api_url = "https://graph.facebook.com/v22.0"
-        # Access token
-        self.access_token = os.getenv("WHATSAPP_ACCESS_TOKEN", "")
-        # Verify token for webhook
-        self.verify_token = os.getenv("WHATSAPP_VERIFY_TOKEN", "banquea_medical_bot_verify_token")
+    def __init__(self, settings: Optional[WhatsAppSettings] = None, max_in_flight: int = 32):
+        settings = settings or get_whatsapp_settings()
+        self.settings = settings
+        self.phone_number_id = settings.phone_number_id
+        self.waba_id = settings.waba_id
+        self.api_url = settings.api_url
+        self.access_token = settings.access_token
+        self.verify_token = settings.verify_token
+        # Encoded once for the constant-time comparison in verify_webhook
+        self._verify_token_bytes = self.verify_token.encode()
+        self._app_secret = settings.app_secret.encode()
+        # Request URL and headers are the same for every outbound message
+        self._messages_endpoint = f"{self.api_url}/{self.phone_number_id}/messages"
+        self._headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json; charset=UTF-8"
+        }
+        # The one cap on concurrent API requests, shared by webhook replies and scheduled jobs;
+        # per-recipient locks keep each user's messages in order
+        self._send_semaphore = asyncio.Semaphore(max_in_flight)
+        self._recipient_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        # Long-lived async HTTP client so sends reuse pooled keep-alive connections
+        self._http = httpx.AsyncClient(
+            # Fail fast on an unreachable host, but give the Graph API 10s to answer
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100)
+        )
+    
+    async def aclose(self):
+        """Close the pooled HTTP connections. Call on application shutdown."""
+        await self._http.aclose()
     
     def verify_webhook(self, mode: str, token: str, challenge: str) -> Optional[str]:
         """
@@ -36,24 +121,41 @@ class WhatsAppClient:
         Returns:
             str: The challenge string if verification passes, None otherwise
         """
-        logger.info("Starting webhook verification...")
-        logger.info(f"Received parameters - mode: {mode}, token: [REDACTED], challenge: {challenge}")
-        logger.info(f"Expected verify_token: [REDACTED] (first 3 chars: {self.verify_token[:3] if self.verify_token else 'None'})")
-        
-        if mode == "subscribe" and token == self.verify_token:
+        # The route already logs the received parameters; no token material is logged here
+        token_matches = bool(self.verify_token) and hmac.compare_digest(token.encode(), self._verify_token_bytes)
+        if mode == "subscribe" and token_matches:
             logger.info("WEBHOOK_VERIFIED: Mode and token match")
             return challenge
         
         # Log specific verification failure reason
         if mode != "subscribe":
-            logger.warning(f"Webhook verification failed: Mode '{mode}' is not 'subscribe'")
-        elif token != self.verify_token:
+            logger.warning("Webhook verification failed: Mode '%s' is not 'subscribe'", mode)
+        elif not token_matches:
             logger.warning("Webhook verification failed: Token mismatch")
         else:
             logger.warning("Webhook verification failed: Unknown reason")
         
         return None
         
+    def verify_signature(self, raw_body: bytes, signature_header: Optional[str]) -> bool:
+        """
+        Check the X-Hub-Signature-256 header Meta sends with each webhook delivery.
+        
+        Args:
+            raw_body: The request body exactly as received
+            signature_header: Value of the X-Hub-Signature-256 header ("sha256=<hex>")
+            
+        Returns:
+            bool: True if the signature matches, or if no app secret is configured
+        """
+        if not self._app_secret:
+            return True
+        if not signature_header:
+            return False
+        expected = hmac.new(self._app_secret, raw_body, hashlib.sha256).hexdigest()
+        # Compare as bytes: compare_digest rejects non-ASCII str, and the header is client-controlled
+        return hmac.compare_digest(expected.encode(), signature_header.removeprefix("sha256=").encode())
+        
     def process_webhook_payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """
         Process incoming webhook payload from WhatsApp.
@@ -65,51 +167,34 @@ class WhatsAppClient:
             Dict with extracted message information
         """
         try:
-            request_id = str(uuid.uuid4())[:8]  # Generate a short request ID for logging
-            logger.info(f"[{request_id}] Processing webhook payload")
+            request_id = new_request_id()  # Tagged onto every log record of this request by RequestIdFilter
+            logger.info("Processing webhook payload")
             
-            # Check for required fields
-            if "object" not in payload:
-                logger.warning(f"[{request_id}] Missing 'object' field in payload")
-                return {}
-                
-            if payload["object"] != "whatsapp_business_account":
-                logger.warning(f"[{request_id}] Object is not 'whatsapp_business_account': {payload['object']}")
-                return {}
-                
-            if "entry" not in payload or not payload["entry"]:
-                logger.warning(f"[{request_id}] Missing 'entry' field in payload")
+            if payload.get("object") != "whatsapp_business_account":
+                logger.warning("Object is not 'whatsapp_business_account': %s", payload.get('object'))
                 return {}
-                
-            # Get the first entry
-            entry = payload["entry"][0]
-            logger.debug(f"[{request_id}] Entry data: {json.dumps(entry)}")
             
-            if "changes" not in entry or not entry["changes"]:
-                logger.warning(f"[{request_id}] Entry missing 'changes' field")
+            # Drill down to the first change's value in one step; any missing level means no usable data
+            try:
+                entry = payload["entry"][0]
+                value = entry["changes"][0]["value"]
+            except (KeyError, IndexError, TypeError):
+                logger.warning("Payload missing entry/changes/value")
                 return {}
-            
-            changes = entry["changes"][0]
-            logger.debug(f"[{request_id}] Changes data: {json.dumps(changes)}")
-            
-            value = changes.get("value", {})
-            logger.debug(f"[{request_id}] Value data: {json.dumps(value)}")
+            logger.debug("Entry data: %s", LazyJson(entry))
             
             # Get messaging product
             messaging_product = value.get("messaging_product")
-            logger.info(f"[{request_id}] Messaging product: {messaging_product}")
-            
             if messaging_product != "whatsapp":
-                logger.warning(f"[{request_id}] Received non-WhatsApp webhook: {messaging_product}")
+                logger.warning("Received non-WhatsApp webhook: %s", messaging_product)
                 return {}
             
             # Extract messages
-            messages = value.get("messages", [])
-            logger.info(f"[{request_id}] Number of messages in payload: {len(messages)}")
+            messages = value.get("messages")
             
             if not messages:
                 # Check if this is a status update
-                statuses = value.get("statuses", [])
+                statuses = value.get("statuses")
                 if statuses:
                     status = statuses[0]
                     status_id = status.get("id")
@@ -117,7 +202,7 @@ class WhatsAppClient:
                     status_status = status.get("status")  # delivered, read, etc.
                     status_timestamp = status.get("timestamp")
                     
-                    logger.info(f"[{request_id}] Message status update - ID: {status_id}, Recipient: {status_recipient_id}, Status: {status_status}, Timestamp: {status_timestamp}")
+                    logger.info("Message status update - ID: %s, Recipient: %s, Status: %s, Timestamp: %s", status_id, status_recipient_id, status_status, status_timestamp)
                     return {
                         "type": "status_update",
                         "status": status_status,
@@ -127,12 +212,14 @@ class WhatsAppClient:
                         "request_id": request_id
                     }
                 
-                logger.info(f"[{request_id}] No messages or statuses in webhook payload")
+                logger.info("No messages or statuses in webhook payload")
                 return {}
             
+            logger.info("Number of messages in payload: %s", len(messages))
+            
             # Get the first message
             message = messages[0]
-            logger.debug(f"[{request_id}] Message data: {json.dumps(message)}")
+            logger.debug("Message data: %s", LazyJson(message))
             
             # Extract message details
             message_type = message.get("type")
@@ -140,71 +227,70 @@ class WhatsAppClient:
             message_id = message.get("id")
             timestamp = message.get("timestamp")
             
-            logger.info(f"[{request_id}] Message details - Type: {message_type}, From: {from_number}, ID: {message_id}, Timestamp: {timestamp}")
+            logger.info("Message details - Type: %s, From: %s, ID: %s, Timestamp: %s", message_type, from_number, message_id, timestamp)
             
             # Extract message content based on type
             body = ""
             interactive_data = {}
             
-            if message_type == "text":
-                text_data = message.get("text", {})
-                body = text_data.get("body", "")
-                logger.info(f"[{request_id}] Text message content: {body}")
-                
-            elif message_type == "interactive":
-                interactive = message.get("interactive", {})
-                interactive_type = interactive.get("type")
-                
-                logger.info(f"[{request_id}] Interactive message type: {interactive_type}")
-                
-                if interactive_type == "list_reply":
-                    list_reply = interactive.get("list_reply", {})
-                    body = list_reply.get("title", "")
-                    logger.info(f"[{request_id}] List reply - ID: {list_reply.get('id')}, Title: {body}, Description: {list_reply.get('description')}")
+            match message_type:
+                case "text":
+                    body = message.get("text", {}).get("body", "")
+                    logger.info("Text message content: %s", body)
                     
-                    interactive_data = {
-                        "reply_type": "list_reply",
-                        "id": list_reply.get("id"),
-                        "title": list_reply.get("title"),
-                        "description": list_reply.get("description")
-                    }
+                case "interactive":
+                    interactive = message.get("interactive", {})
+                    interactive_type = interactive.get("type")
                     
-                elif interactive_type == "button_reply":
-                    button_reply = interactive.get("button_reply", {})
-                    body = button_reply.get("title", "")
-                    logger.info(f"[{request_id}] Button reply - ID: {button_reply.get('id')}, Title: {body}")
+                    logger.info("Interactive message type: %s", interactive_type)
                     
+                    if interactive_type == "list_reply":
+                        list_reply = interactive.get("list_reply", {})
+                        body = list_reply.get("title", "")
+                        logger.info("List reply - ID: %s, Title: %s, Description: %s", list_reply.get('id'), body, list_reply.get('description'))
+                        
+                        interactive_data = {
+                            "reply_type": "list_reply",
+                            "id": list_reply.get("id"),
+                            "title": list_reply.get("title"),
+                            "description": list_reply.get("description")
+                        }
+                        
+                    elif interactive_type == "button_reply":
+                        button_reply = interactive.get("button_reply", {})
+                        body = button_reply.get("title", "")
+                        logger.info("Button reply - ID: %s, Title: %s", button_reply.get('id'), body)
+                        
+                        interactive_data = {
+                            "reply_type": "button_reply",
+                            "id": button_reply.get("id"),
+                            "title": button_reply.get("title")
+                        }
+                
+                case "button":
+                    # Handle direct button messages (from templates)
+                    button_data = message.get("button", {})
+                    body = button_data.get("text", "")
+                    button_payload = button_data.get("payload", "")
+                    
+                    logger.info("Button message - Text: %s, Payload: %s", body, button_payload)
+                    
+                    # Treat button messages similar to button_reply for consistency
                     interactive_data = {
-                        "reply_type": "button_reply",
-                        "id": button_reply.get("id"),
-                        "title": button_reply.get("title")
+                        "reply_type": "template_button",
+                        "title": body,
+                        "payload": button_payload
                     }
             
-            elif message_type == "button":
-                # Handle direct button messages (from templates)
-                button_data = message.get("button", {})
-                body = button_data.get("text", "")
-                payload = button_data.get("payload", "")
-                
-                logger.info(f"[{request_id}] Button message - Text: {body}, Payload: {payload}")
-                
-                # Treat button messages similar to button_reply for consistency
-                interactive_data = {
-                    "reply_type": "template_button",
-                    "title": body,
-                    "payload": payload
-                }
-            
             # Contact info if available
             contact_name = None
-            if "contacts" in value and value["contacts"]:
-                contact = value["contacts"][0]
-                if "profile" in contact:
-                    contact_name = contact["profile"].get("name")
-                    logger.info(f"[{request_id}] Contact name: {contact_name}")
+            contacts = value.get("contacts")
+            if contacts and "profile" in contacts[0]:
+                contact_name = contacts[0]["profile"].get("name")
+                logger.info("Contact name: %s", contact_name)
             
             # Log the message data
-            logger.info(f"[{request_id}] Processed message: type={message_type}, body={body}, interactive_data={json.dumps(interactive_data)}")
+            logger.info("Processed message: type=%s, body=%s, interactive_data=%s", message_type, body, LazyJson(interactive_data))
             
             # Return structured information
             result = {
@@ -219,18 +305,71 @@ class WhatsAppClient:
                 "request_id": request_id
             }
             
-            logger.debug(f"[{request_id}] Extracted payload result: {json.dumps(result)}")
+            logger.debug("Extracted payload result: %s", LazyJson(result))
             return result
             
         except Exception as e:
-            logger.error(f"Error processing webhook payload: {str(e)}", exc_info=True)
+            logger.error("Error processing webhook payload: %s", e, exc_info=True)
             # Log the payload that caused the error for debugging
             try:
-                logger.error(f"Problem payload: {json.dumps(payload)}")
+                logger.error("Problem payload: %s", json.dumps(payload))
             except:
-                logger.error(f"Could not serialize problem payload")
+                logger.error("Could not serialize problem payload")
             return {}
             
+    async def _post(self, to_number: str, payload: Dict[str, Any], kind: str) -> bool:
+        """
+        POST a message payload to the Cloud API.
+        
+        Sends to the same recipient go out one at a time, in call order, so concurrent
+        callers never reorder a user's messages; different recipients proceed in parallel
+        up to the client's in-flight limit.
+        
+        Args:
+            to_number: The recipient's phone number
+            payload: Complete message payload
+            kind: Message kind used in log lines (e.g. "template message")
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        lock = self._recipient_locks.get(to_number)
+        if lock is None:
+            lock = self._recipient_locks[to_number] = asyncio.Lock()
+        try:
+            async with lock, self._send_semaphore:
+                # Serialize payload preserving Unicode
+                payload_str = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                response = await self._http.post(self._messages_endpoint, headers=self._headers, content=payload_str)
+            response_data = response.json()
+            
+            if response.status_code == 200:
+                logger.info("%s sent successfully. Message ID: %s", kind.capitalize(), response_data.get('messages', [{}])[0].get('id'))
+                return True
+            else:
+                logger.error("Failed to send %s. Status code: %s, Response: %s", kind, response.status_code, LazyJson(response_data))
+                return False
+                
+        except Exception as e:
+            logger.error("Error sending %s: %s", kind, e, exc_info=True)
+            return False
+    
+    async def send_many(self, messages: List[Tuple[str, str]]) -> List[bool]:
+        """
+        Send several text messages concurrently. Messages to the same recipient
+        are delivered in list order.
+        
+        Args:
+            messages: (to_number, message_text) pairs
+            
+        Returns:
+            List of per-message results, in the same order as `messages`
+        """
+        return await asyncio.gather(*(
+            self.send_text_message(to_number=to_number, message_text=message_text)
+            for to_number, message_text in messages
+        ))
+            
     async def send_text_message(self, to_number: str, message_text: str) -> bool:
         """
         Send a plain text message to a WhatsApp user.
@@ -242,40 +381,17 @@ class WhatsAppClient:
         Returns:
             bool: True if successful, False otherwise
         """
-        endpoint = f"{self.api_url}/{self.phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json; charset=UTF-8"
-        }
-        
         payload = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
+            **TEXT_MESSAGE_BASE,
             "to": to_number,
-            "type": "text",
             "text": {
                 "preview_url": False,
                 "body": message_text
             }
         }
         
-        try:
-            logger.info(f"Sending text message to {to_number}: {message_text[:50]}...")
-            # Serialize payload preserving Unicode
-            payload_str = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-            response = requests.post(endpoint, headers=headers, data=payload_str)
-            response_data = response.json()
-            
-            if response.status_code == 200:
-                logger.info(f"Message sent successfully. Message ID: {response_data.get('messages', [{}])[0].get('id')}")
-                return True
-            else:
-                logger.error(f"Failed to send message. Status code: {response.status_code}, Response: {json.dumps(response_data)}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"Error sending message: {str(e)}", exc_info=True)
-            return False
+        logger.info("Sending text message to %s: %.50s...", to_number, message_text)
+        return await self._post(to_number, payload, "message")
             
     async def send_template_message(self, to_number: str, template_name: str, language: str = "es", components: List[Dict] = None) -> bool:
         """
@@ -290,12 +406,6 @@ class WhatsAppClient:
         Returns:
             bool: True if successful, False otherwise
         """
-        endpoint = f"{self.api_url}/{self.phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json; charset=UTF-8"
-        }
-        
         template_data = {
             "name": template_name,
             "language": {
@@ -307,29 +417,13 @@ class WhatsAppClient:
             template_data["components"] = components
         
         payload = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
+            **TEMPLATE_MESSAGE_BASE,
             "to": to_number,
-            "type": "template",
             "template": template_data
         }
         
-        try:
-            logger.info(f"Sending template message '{template_name}' to {to_number}")
-            payload_str = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-            response = requests.post(endpoint, headers=headers, data=payload_str)
-            response_data = response.json()
-            
-            if response.status_code == 200:
-                logger.info(f"Template message sent successfully. Message ID: {response_data.get('messages', [{}])[0].get('id')}")
-                return True
-            else:
-                logger.error(f"Failed to send template message. Status code: {response.status_code}, Response: {json.dumps(response_data)}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"Error sending template message: {str(e)}", exc_info=True)
-            return False
+        logger.info("Sending template message '%s' to %s", template_name, to_number)
+        return await self._post(to_number, payload, "template message")
     
     async def send_interactive_list_message(self, to_number: str, header_text: str, body_text: str, footer_text: str, button_text: str, sections: List[Dict]) -> bool:
         """
@@ -346,17 +440,9 @@ class WhatsAppClient:
         Returns:
             bool: True if successful, False otherwise
         """
-        endpoint = f"{self.api_url}/{self.phone_number_id}/messages"
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json; charset=UTF-8"
-        }
-        
         payload = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
+            **INTERACTIVE_MESSAGE_BASE,
             "to": to_number,
-            "type": "interactive",
             "interactive": {
                 "type": "list",
                 "header": {
@@ -376,19 +462,21 @@ class WhatsAppClient:
             }
         }
         
-        try:
-            logger.info(f"Sending interactive list message to {to_number}")
-            payload_str = json.dumps(payload, ensure_ascii=False).encode('utf-8')
-            response = requests.post(endpoint, headers=headers, data=payload_str)
-            response_data = response.json()
-            
-            if response.status_code == 200:
-                logger.info(f"Interactive list message sent successfully. Message ID: {response_data.get('messages', [{}])[0].get('id')}")
-                return True
-            else:
-                logger.error(f"Failed to send interactive list message. Status code: {response.status_code}, Response: {json.dumps(response_data)}")
-                return False
-                
-        except Exception as e:
-            logger.error(f"Error sending interactive list message: {str(e)}", exc_info=True)
-            return False
\ No newline at end of file
+        logger.info("Sending interactive list message to %s", to_number)
+        return await self._post(to_number, payload, "interactive list message")
+
+@lru_cache(maxsize=1)
+def get_whatsapp_client() -> WhatsAppClient:
+    """
+    Return the process-wide WhatsApp client, building it on first use.
+    The webhook routes take it through Depends(get_whatsapp_client).
+    
+    Overriding this dependency only affects those routes: message_handler and
+    scheduler import the module-level `whatsapp_client` below. To swap the client
+    everywhere, patch `whatsapp_client` in src.whatsapp, src.message_handler and
+    src.scheduler, e.g. with unittest.mock.patch.
+    """
+    return WhatsAppClient()
+
+# Shared client so the webhook, message handlers and scheduler jobs use one connection pool
+whatsapp_client = get_whatsapp_client()
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+
+from src.request_context import RequestIdFilter, new_request_id, request_id_var, run_in_clean_context
+
+
+class _RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.addFilter(RequestIdFilter())
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _schedule_job(loop, job):
+    """Mimics APScheduler on asyncio: the wakeup goes through call_later and the job runs as a task"""
+    loop.call_later(0, lambda: loop.create_task(job()))
+
+
+def _run_scheduled_job(wrap_in_clean_context):
+    logger = logging.getLogger("tests.request_context")
+    logger.setLevel(logging.INFO)
+    handler = _RecordingHandler()
+    logger.addHandler(handler)
+
+    async def job():
+        logger.info("job ran")
+
+    async def handle_webhook():
+        request_id = new_request_id()
+        loop = asyncio.get_running_loop()
+        if wrap_in_clean_context:
+            run_in_clean_context(_schedule_job, loop, job)
+        else:
+            _schedule_job(loop, job)
+        await asyncio.sleep(0.05)
+        return request_id
+
+    try:
+        request_id = asyncio.run(handle_webhook())
+    finally:
+        logger.removeHandler(handler)
+    [record] = handler.records
+    return request_id, record.request_id
+
+
+def test_job_scheduled_from_clean_context_does_not_inherit_request_id():
+    request_id, job_request_id = _run_scheduled_job(wrap_in_clean_context=True)
+    assert job_request_id == "-"
+    assert job_request_id != request_id
+
+
+def test_job_scheduled_from_request_context_inherits_request_id():
+    # Why the scheduler adds jobs through run_in_clean_context
+    request_id, job_request_id = _run_scheduled_job(wrap_in_clean_context=False)
+    assert job_request_id == request_id
+
+
+def test_filter_uses_default_outside_requests():
+    record = logging.LogRecord("x", logging.INFO, __file__, 1, "msg", None, None)
+    assert RequestIdFilter().filter(record)
+    assert record.request_id == request_id_var.get() == "-"